@@ -9,10 +9,15 @@
 # 2013-02-02, V0.2 jw - check_words() now remembers a wordlist, pushes all out 
 #                       with an extra thread, reads back async, and reassembles.
 #                       This is much more efficient
+# 2026-10-18, V0.3    - one hunspell process is kept for all check_words() calls.
+#                       A writer thread replaces the fork(), it feeds the words in batches.
+#                       _readline() reads into a bytearray, without quadratic copying.
+# 2026-10-18, V0.4    - class HunspellDict: the .dic/.aff word lists in process, with
+#                       affix expansion. Only unknown words need the hunspell process.
 #
-import os,subprocess,re
+import os,subprocess,re,threading,codecs
 
-__VERSION__ = '0.2'
+__VERSION__ = '0.4'
 
 class Hunspell():
     """A pure python module to interface with hunspell.
@@ -25,10 +30,11 @@ class Hunspell():
         self.dicts = dicts
         self.proc = None
         self.attr = None
-        self.buffer = ''
+        self.buffer = bytearray()
+        self.pos = 0
 
     def _start(self):
-        cmd = self.cmd
+        cmd = list(self.cmd)
         if self.dicts is not None and len(self.dicts): 
             cmd += ['-d', ','.join(self.dicts)]
         try:
@@ -37,9 +43,15 @@ class Hunspell():
         except OSError as e:
             self.proc = "%s failed: errno=%d %s" % (cmd, e.errno, e.strerror)
             raise OSError(self.proc)
+        self.buffer = bytearray()
+        self.pos = 0
         header = ''
         while True:
-            more = self.proc.stdout.readline().rstrip()
+            more = self._readline()
+            if not len(more):
+                self.proc = "%s failed: no version line" % cmd
+                raise OSError(self.proc)
+            more = more.rstrip()
             if len(more) > 5 and more[0:5] == '@(#) ':    # version line with -a
                 self.version = more[5:]
                 break
@@ -49,29 +61,41 @@ class Hunspell():
             else:
                 header += more  # stderr should be collected here. It does not work
         if len(header): self.header = header
-        self.buffer = ''
         
     def _readline(self):
         # python readline() is horribly stupid on this pipe. It reads single
         # byte, just like java did in the 1980ies. Sorry, this is not
         # acceptable in 2013.
+        # We read whatever the pipe has into a bytearray, and only advance 
+        # self.pos over the lines returned. The consumed head is cut off, 
+        # when it is more than half of the buffer.
         if self.proc is None:
-            raise Error("Hunspell_readline before _start")
+            raise OSError("Hunspell._readline before _start")
         while True:
-            idx = self.buffer.find('\n')
-            if idx < 0:
-                more = self.proc.stdout.read()
-                if not len(more):
-                    r = self.buffer
-                    self.buffer = ''
-                    return r
-                self.buffer += more
-            else:
+            idx = self.buffer.find('\n', self.pos)
+            if idx >= 0:
                 break
-        r = self.buffer[0:idx+1]
-        self.buffer = self.buffer[idx+1:]
+            more = os.read(self.proc.stdout.fileno(), 65536)
+            if not len(more):
+                r = str(self.buffer[self.pos:])
+                self.buffer = bytearray()
+                self.pos = 0
+                return r
+            if self.pos > len(self.buffer) // 2:
+                del self.buffer[:self.pos]
+                self.pos = 0
+            self.buffer += more
+        r = str(self.buffer[self.pos:idx+1])
+        self.pos = idx+1
         return r
 
+    def close(self):
+        """terminates the hunspell process. The next check_words() starts a new one."""
+        if hasattr(self.proc, 'poll'):
+            self.proc.stdin.close()
+            self.proc.wait()
+        self.proc = None
+
     def _load_attr(self):
         try:
             p = subprocess.Popen(self.cmd + ['-D'], shell=False, 
@@ -131,30 +155,45 @@ class Hunspell():
         if self.attr is None: self._load_attr()
         return self.attr['LOADED DICTIONARY']
  
-    def check_words(self, words):
+    def check_words(self, words, batch=1000):
         """takes a list of words as parameter, and checks them against the 
            loaded spelling dictionaries. A key value dict is returned, where
            every key represents a word that was not found in the 
            spelling dictionaries. Values are lists of correction suggestions.
            check_words() is implemented by calling the hunspell binary in pipe mode.
-           This is fairly robust, but not optimized for efficiency.
+           The hunspell process is started once, and reused by the next call.
+           A writer thread feeds it batch words per write, while we read the 
+           replies. Each input line is answered by an empty line, this tells
+           us when all words are done.
         """
-        if self.proc is None:
+        if not hasattr(self.proc, 'poll') or self.proc.poll() is not None:
             self._start()
-        childpid = os.fork()
-        if childpid == 0:
-            for w in words:
-                self.proc.stdin.write(("^"+w+"\n").encode('utf8'))
-            os._exit(0)
-        self.proc.stdin.close()
+        lines = [("^"+w.replace('\n', ' ')+"\n").encode('utf8') for w in words]
+        stdin = self.proc.stdin
+        def writer():
+            try:
+                for i in range(0, len(lines), batch):
+                    stdin.write(''.join(lines[i:i+batch]))
+                    stdin.flush()
+            except IOError:
+                pass    # hunspell is gone, the reader sees end of file.
+        t = threading.Thread(target=writer)
+        t.daemon = True
+        t.start()
         bad_words = {}
+        pending = len(lines)
  
-        while True:
+        while pending:
             line = self._readline()
             if len(line) == 0:
+                print "hunspell terminated, %d words unchecked" % pending
+                self.proc = None
                 break
             line = line.rstrip()
-            if not len(line) or line[0] in '*+-': continue
+            if not len(line):
+                pending -= 1
+                continue
+            if line[0] in '*+-': continue
  
             if line[0] == '#': 
                 car = line.split(' ')
@@ -170,9 +209,160 @@ class Hunspell():
                 bad_words[car[1]] = cdr
             else:
                 print("bad hunspell reply: %s, split as %s" % (line, a))
-        self.proc = None
+        t.join()
         return bad_words
 
+class HunspellDict():
+    """An in-process word list, loaded from the .dic/.aff files that hunspell uses.
+       The affix rules are expanded when loading, so that known() is a plain
+       set lookup. This is only a positive check: a word found here is known
+       to hunspell. Everything else (compounds, continuation classes, 
+       suggestions) is left to the hunspell process, see unknown_words().
+       If you pass wordlists=None, the personal dictionaries ~/.hunspell_<name> 
+       of the loaded dictionaries are added.
+    """
+    def __init__(self, dics=[], wordlists=None):
+        self.words = set()
+        self.forbidden = set()
+        seen = []
+        for d in dics:
+            base = re.sub('\.(dic|aff)$', '', d)
+            if not base in seen: seen.append(base)
+        for base in seen:
+            self.load_dic(base + '.dic', base + '.aff')
+        if wordlists is None:
+            wordlists = [os.path.expanduser('~/.hunspell_' + os.path.basename(b)) for b in seen]
+            wordlists = [w for w in wordlists if os.path.exists(w)]
+        for w in wordlists:
+            self.load_wordlist(w)
+
+    def __len__(self):
+        return len(self.words)
+
+    def _decode(self, data, enc):
+        enc = enc.lower().replace('microsoft-', '')
+        try:
+            codecs.lookup(enc)
+        except LookupError:
+            enc = 'latin-1'
+        return data.decode(enc, 'replace')
+
+    def _flags(self, s, flag_type, aliases):
+        if aliases and s.isdigit():
+            return aliases[int(s)-1] if 0 < int(s) <= len(aliases) else []
+        if flag_type == 'long':
+            return [s[i:i+2] for i in range(0, len(s), 2)]
+        if flag_type == 'num':
+            return s.split(',')
+        return list(s)
+
+    def _condition(self, cond, kind):
+        if cond == '.': return None
+        # hunspell conditions only know '.', '[...]' and '[^...]'.
+        r = ''.join([c if c in '.[]^' else re.escape(c) for c in cond])
+        if kind == 'SFX': return re.compile(r + '$', re.U)
+        return re.compile('^' + r, re.U)
+
+    def load_dic(self, dic, aff=None):
+        """adds the words of a hunspell .dic file, expanded with the prefix and suffix 
+           rules of its .aff file. Affix rules with continuation classes are applied 
+           once, without the continuation.
+        """
+        flag_type = 'char'
+        aliases = None
+        rules = {}      # flag: (kind, cross_product, [(strip, append, condition), ...])
+        special = {}
+        enc = 'ISO8859-1'
+        if aff is not None and os.path.exists(aff):
+            data = open(aff, 'rb').read()
+            m = re.search(r'^SET\s+(\S+)', data, re.M)
+            if m: enc = m.group(1)
+            for line in self._decode(data, enc).split('\n'):
+                a = line.split()
+                if not len(a) or a[0][0] == '#': continue
+                if a[0] == 'FLAG' and len(a) > 1:
+                    flag_type = a[1].lower()
+                elif a[0] == 'AF' and len(a) > 1:
+                    if aliases is None: aliases = []            # AF <count>
+                    else: aliases.append(self._flags(a[1], flag_type, None))
+                elif a[0] in ('NEEDAFFIX', 'PSEUDOROOT', 'ONLYINCOMPOUND', 'FORBIDDENWORD') and len(a) > 1:
+                    special[a[0]] = a[1]
+                elif a[0] in ('PFX', 'SFX') and len(a) >= 4:
+                    if not a[1] in rules:
+                        rules[a[1]] = (a[0], a[2] == 'Y', [])     # PFX <flag> <Y|N> <count>
+                        continue
+                    strip = '' if a[2] == '0' else a[2]
+                    append = a[3].split('/')[0]
+                    if append == '0': append = ''
+                    cond = self._condition(a[4] if len(a) > 4 else '.', a[0])
+                    rules[a[1]][2].append((strip, append, cond))
+        no_root = set([special.get('NEEDAFFIX'), special.get('PSEUDOROOT'), special.get('ONLYINCOMPOUND')])
+        no_root.discard(None)
+        forbidden = special.get('FORBIDDENWORD')
+
+        lines = self._decode(open(dic, 'rb').read(), enc).split('\n')
+        if len(lines) and lines[0].strip().isdigit(): lines = lines[1:]
+        words = self.words
+        for line in lines:
+            a = line.split()
+            if not len(a): continue
+            word, slash, fl = a[0].partition('/')
+            flags = self._flags(fl, flag_type, aliases) if slash else []
+            if forbidden in flags:
+                self.forbidden.add(word)
+                continue
+            if not no_root.intersection(flags):
+                words.add(word)
+            crossed = [word]
+            for f in flags:
+                r = rules.get(f)
+                if r is None or r[0] != 'SFX': continue
+                for strip, append, cond in r[2]:
+                    if word.endswith(strip) and (cond is None or cond.search(word)):
+                        w = word[:len(word)-len(strip)] + append
+                        words.add(w)
+                        if r[1]: crossed.append(w)
+            for f in flags:
+                r = rules.get(f)
+                if r is None or r[0] != 'PFX': continue
+                for strip, append, cond in r[2]:
+                    for w in (crossed if r[1] else [word]):
+                        if w.startswith(strip) and (cond is None or cond.search(w)):
+                            words.add(append + w[len(strip):])
+        words -= self.forbidden
+
+    def load_wordlist(self, fname):
+        """adds the words of a plain word list, one per line. This is the format
+           of the personal dictionaries, where '*word' forbids a word.
+        """
+        for line in codecs.open(fname, 'r', 'utf8', 'replace'):
+            word = line.strip().split('/')[0]
+            if not len(word): continue
+            if word[0] == '*':
+                self.forbidden.add(word[1:])
+                self.words.discard(word[1:])
+            else:
+                self.words.add(word)
+
+    def known(self, word):
+        """True, if word or its lowercase or capitalized form is in the dictionary,
+           following the capitalization rules of hunspell.
+        """
+        if isinstance(word, str): word = word.decode('utf8', 'replace')
+        if word in self.words: return True
+        if word in self.forbidden: return False
+        lower = word.lower()
+        if word[1:] == lower[1:] and lower in self.words: return True     # Capitalized
+        if word.isupper():
+            return lower in self.words or lower.capitalize() in self.words
+        return False
+
+    def unknown_words(self, words):
+        """returns the list of words that are not known(). Only these need to be
+           checked by the hunspell process.
+        """
+        return [w for w in words if not self.known(w)]
+
  
 if __name__ == "__main__": 
     from pprint import pprint
@@ -182,3 +372,6 @@ if __name__ == "__main__":
     pprint(h.check_words(["ppppp", '123', '', 'gorkicht', 'gemank', 'haus', '']))
     pprint(h.check_words(["Radae", 'blood', 'mensch', 'green', 'blea', 'fork']))
     pprint(h.version)
+    d = HunspellDict(h.dicts_loaded())
+    pprint((len(d), d.unknown_words(["Radae", 'blood', 'mensch', 'green', 'blea', 'fork'])))
+    h.close()
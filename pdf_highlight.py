@@ -89,6 +89,44 @@
 # 2014-01-07, V1.6.5 jw - manually merged https://github.com/jnweiger/pdfcompare/pull/4
 #                         hope, I did not break too much...
 # 2014-11-07, V1.6.6 jw - hint added for hunspell use: add word.
+# 2026-10-18, V1.7.0    - pdftohtml runs in parallel for both documents, large documents
+#                         are split into page ranges, and stitched back: options -j, --chunk-pages.
+#                       - option --stream added: iterparse page by page, one pass over all pages.
+#                       - option --diff-engine added: myers, histogram, patience as alternatives
+#                         to difflib.SequenceMatcher.
+#                       - WordInterner: the diff runs on array('i') word ids, not on DecoratedWord.
+#                       - WordTable: wordlists are stored column wise in arrays, coordinates
+#                         are parsed once per text run.
+#                       - opcodes_find_moved() no longer compares all inserts with all deletes,
+#                         move_candidates() uses a prefix filtered index of rare words.
+#                         Length and quick_ratio() bounds come before ratio(), --debug counts rejects.
+#                       - FontAdvances: glyph advance widths are cached per font, marks are
+#                         placed with prefix sums per text run.
+#                       - fonts are loaded once per family and size, and only when needed.
+#                         option --font-cache added.
+#                       - option --metrics added: glyph widths from pygame, TrueType hmtx tables,
+#                         or the standard 14 AFM widths. pygame is only imported if used.
+#                       - page overlays are rendered in a process pool (-j), merged in page order.
+#                       - option --single-canvas added: all overlays in one multipage PDF,
+#                         navigation links resolve without page_ref_magic.
+#                       - option --unchanged-pages added: pages without marks get a shared
+#                         watermark overlay, or are copied untouched.
+#                       - watermark and margins are a Form XObject, shared by all pages of the same size.
+#                       - option --incremental added: appends the changed objects to a byte copy of
+#                         the input, as a PDF incremental update.
+#                       - option --cache-dir added: the words of the older pdf are cached by content hash.
+#                       - PageAnchoredMatcher: identical pages are matched by a fingerprint, 
+#                         the word diff only runs on the pages between them. Not for 'difflib',
+#                         which stays the unanchored reference, see word_matcher().
+#                       - diff_split(): common prefix and suffix, and words unique in both 
+#                         documents cut the word diff into independent ranges, diffed in parallel (-j).
+#                       - option --batch added: many comparisons in one process, or one pool (-j).
+#                       - option --serve added: comparisons over local HTTP, or a unix domain socket.
+#                       - Hunspell: one persistent process, fed by a writer thread, see hunspell.py V0.3
+#                       - --spell runs up to -j hunspell processes, verdicts are cached in --cache-dir.
+#                       - --spell looks up known words in process, see class HunspellDict in hunspell.py V0.4
+#                       - multiple -s and --search-file, compiled once into a SearchMatcher.
+#                       - --index writes a SearchIndex next to the pdf, later searches skip pdftohtml.
 #
 # osc in devel:languages:python python-pypdf >= 1.13+20130112
 #  need fix from https://bugs.launchpad.net/pypdf/+bug/242756
@@ -116,7 +154,7 @@ from __future__ import with_statement
 from __future__ import print_function
 # from __future__ import division
 
-__VERSION__ = '1.6.6'
+__VERSION__ = '1.7.0'
 
 try:
   # python2
@@ -127,15 +165,20 @@ except ImportError:
 from PyPDF2 import PdfFileWriter, PdfFileReader, generic as Pdf
 from reportlab.pdfgen import canvas
 from reportlab.lib.colors import Color
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFontFile, TTFError
 import urllib   # used when normal encode fails.
 
-import re, time
+import re, time, bisect, math
 from pprint import pprint
 import xml.etree.cElementTree as ET
-import sys, os, subprocess
+import sys, os, stat, subprocess, tempfile, json, marshal, zlib, hashlib, csv, shlex, threading
 from argparse import ArgumentParser
-import pygame.font as PGF
+from multiprocessing import cpu_count, Pool
+from multiprocessing.pool import ThreadPool
+PGF = None      # pygame.font, imported by pygame_font() only if --metrics pygame is used.
 from difflib import SequenceMatcher
+from array import array
 # FIXME: class Hunspell should be loaded as a module
 # import HunspellPure
 
@@ -149,6 +192,14 @@ debug = False
 page_ref_magic = "675849302 to page "     # a token we use to patch the page objects.
 page_ref_plain = "to page "     # this will be visible as a popup on navigation marks.
 
+pdf2xml_min_chunk = 20 # never split a document into page range chunks smaller than this.
+wordlist_cache_max = 512<<20   # bytes in --cache-dir, beyond this the least recently used are removed.
+wordlist_cache_version = 1     # change this, when WordTable or xml2wordlist() change.
+search_index_version = 1       # change this, when SearchIndex changes.
+hunspell_checkers = []         # Hunspell processes for --spell, kept for all runs of this process.
+spell_min_shard = 1000         # words per hunspell process, at least.
+hunspell_dict = None           # HunspellDict of the loaded dictionaries, known words skip hunspell.
+
 highlight_height = 1.2  # some fonts cause too much overlap with 1.4
                         # 1.2 is often not enough to look symmetric.
 
@@ -156,7 +207,7 @@ highlight_height = 1.2  # some fonts cause too much overlap with 1.4
 # FONT_METRICS['Helvetica'][1]['W']
 #  944
 
-def mergeAnnotsRelocate(dest_p, src_p, first_page=0):
+def mergeAnnotsRelocate(dest_p, src_p, first_page=0, relocate=True):
   ### Links to Pages look like this:
   # <<
   # /Contents (to page 1)
@@ -176,6 +227,8 @@ def mergeAnnotsRelocate(dest_p, src_p, first_page=0):
   # entries where the IndirectObject() points to the src_p itself.
   # We replace this IndirectObject() with the one of the referenced page 
   # from dest_p's stream.
+  # With relocate=False, the annotations are only merged. render_overlays() 
+  # has no need for the hack.
 
   # First we fetch the list of all IndirectObject()s for all the pages 
   # in the dest stream.
@@ -189,7 +242,7 @@ def mergeAnnotsRelocate(dest_p, src_p, first_page=0):
 
   if "/Annots" in src_p:
     annots = src_p["/Annots"] 
-    for a in annots:
+    for a in (annots if relocate else []):
       o = a.getObject() # a is an IndirectObject()
       if "/Contents" in o:
         if debug > 1: pprint(["mergeAnnots old:", o])
@@ -215,7 +268,9 @@ def mergeAnnotsRelocate(dest_p, src_p, first_page=0):
       dest_p[Pdf.NameObject("/Annots")] = annots
 
 
-def page_changemarks(canvas, mediabox, cropbox, marks, page_idx, trans=0.5, leftside=None, cb_x=None, cb_w=0.007, min_w=0.01, ext_w=0.05, features='C,H,A,N'):
+def page_changemarks(canvas, mediabox, cropbox, marks, page_idx, trans=0.5, leftside=None, cb_x=None, cb_w=0.007, min_w=0.01, ext_w=0.05, features='C,H,A,N', nav_pages=None):
+  # nav_pages maps page_idx to page numbers of a multipage canvas, see render_overlays().
+  # Without, navigation links are self references, relocated by mergeAnnotsRelocate().
   # cb_x=0.98 changebar near right edge
   # cb_x=0.02 changebar near left edge
   # min_w=0.05: each mark is min 5% of the page width wide. If not we add extenders.
@@ -260,6 +315,9 @@ def page_changemarks(canvas, mediabox, cropbox, marks, page_idx, trans=0.5, left
     else:
       x=w-r-r
     canv.wedge(x,-r, x+r+r,r,     45,90, fill=1, stroke=0)     # bottom
+    if nav_pages is not None:
+      canv.linkAbsolute(page_ref_plain+str(target_page), "jump_"+str(nav_pages[target_page]), (x,0, x+r+r,r))
+      return
     dest = "jump_"+str(canv.getPageNumber())
     canv.linkAbsolute(page_ref_magic+str(target_page), dest, (x,0, x+r+r,r))
     if debug:
@@ -274,6 +332,9 @@ def page_changemarks(canvas, mediabox, cropbox, marks, page_idx, trans=0.5, left
     else:
       x=w-r-r
     canv.wedge(x,h-r, x+r+r,h+r, 225,90, fill=1, stroke=0)     # top
+    if nav_pages is not None:
+      canv.linkAbsolute(page_ref_plain+str(target_page), "jump_"+str(nav_pages[target_page]), (x,h, x+r+r,h-r))
+      return
     dest = "jump_"+str(canv.getPageNumber())
     canv.linkAbsolute(page_ref_magic+str(target_page), dest, (x,h, x+r+r,h-r))
 
@@ -394,6 +455,287 @@ def page_watermark(canv, box, argv, color=[1,0,1], trans=0.5, p_w=None, p_h=None
     canv.setFillColor(Color(color[0],color[1],color[2], alpha=trans))
     canv.drawString(15,10,text)
 
+def render_overlay(job):
+  """ paints the watermark and the changemarks of one page on a canvas of 
+      its own and returns the canvas as PDF bytes. 
+      job is a dict with the page geometry, its marks and the options,
+      see main(). This is a top level function, so that a 
+      multiprocessing.Pool can render many pages in parallel.
+  """
+  global debug
+  debug = job['debug']
+  ## create a canvas of correct size, 
+  ## paint semi-transparent highlights on the canvas,
+  ## then save the canvas to memory string as proper PDF.
+  pdf_str = StringIO()
+  c = canvas.Canvas(pdf_str, pagesize=(job['mbox'][2],job['mbox'][3]))
+  paint_overlay(c, job)
+  c.save()
+  return pdf_str.getvalue()
+
+def render_overlays(jobs):
+  """ like render_overlay(), but all jobs are painted on the pages of one 
+      canvas, and returned as one multipage PDF. This saves the document
+      setup and the parsing per page. Navigation links point to their
+      target page directly.
+  """
+  nav_pages = {}
+  for n in range(len(jobs)):
+    nav_pages[jobs[n]['page_idx']] = n+1        # canvas pages count from 1
+  pdf_str = StringIO()
+  c = canvas.Canvas(pdf_str)
+  for job in jobs:
+    c.setPageSize((job['mbox'][2],job['mbox'][3]))
+    paint_overlay(c, job, nav_pages)
+    c.showPage()
+  c.save()
+  return pdf_str.getvalue()
+
+def paint_overlay(c, job, nav_pages=None):
+  if job['watermark']:
+    page_watermark(c, job['cbox'], job['argv'], color=job['color'], trans=job['trans'], 
+                   p_w=job['marks']['w'], p_h=job['marks']['h'], margins=job['margins'], features=job['features'])
+  page_changemarks(c, job['mbox'], job['cbox'], job['marks'], job['page_idx'], trans=job['trans'], 
+                   leftside=job['leftside'], features=job['features'], nav_pages=nav_pages)
+
+  # c.textAnnotation('Here is a Note', Rect=[34,0,0,615], addtopage=1,Author='Test Opacity=0.1',Color=[0.7,0.8,1],Type='/Comment',Opacity=0.1)
+  # c.linkURL(".: Here is a Note", (30,10,200,20), relative=0, Border="[ 1 1 1 ]")
+
+def watermark_xobject(output, job, compress=True):
+  """ paints the watermark and the margins of a page, as page_watermark() 
+      does, into a Form XObject, and adds it to output.
+      Returns its IndirectObject, or None if there is nothing to paint.
+      All pages of the same geometry can share it, see stamp_xobject().
+  """
+  pdf_str = StringIO()
+  c = canvas.Canvas(pdf_str, pagesize=(job['mbox'][2],job['mbox'][3]))
+  page_watermark(c, job['cbox'], job['argv'], color=job['color'], trans=job['trans'], 
+                 p_w=job['marks']['w'], p_h=job['marks']['h'], margins=job['margins'], features=job['features'])
+  c.save()
+  wm_page = PdfFileReader(pdf_str).getPage(0)
+  data = wm_page.getContents().getData()
+  if not len(data.strip()): return None
+  form = Pdf.DecodedStreamObject()
+  form.setData(data)
+  if compress: form = form.flateEncode()      # keeps only /Filter, set the rest after.
+  form[Pdf.NameObject('/Type')] = Pdf.NameObject('/XObject')
+  form[Pdf.NameObject('/Subtype')] = Pdf.NameObject('/Form')
+  form[Pdf.NameObject('/BBox')] = wm_page['/MediaBox']
+  form[Pdf.NameObject('/Resources')] = wm_page['/Resources']
+  return output._addObject(form)
+
+def stamp_streams(output, name):
+  """ adds the streams 'q' and 'Q <name> Do' to output, that stamp_xobject() 
+      puts around the page contents. Returns their IndirectObjects.
+      The second one starts with a newline: readers (and PyPDF2's ContentStream) 
+      concatenate the streams of a page, and the page contents may end without 
+      whitespace, e.g. in 'ET'.
+  """
+  before = Pdf.DecodedStreamObject()
+  before.setData('q\n')
+  after = Pdf.DecodedStreamObject()
+  after.setData('\nQ\n%s Do\n' % name)
+  return (output._addObject(before), output._addObject(after))
+
+def stamp_xobject(output, page, name, xobj, content_before, content_after):
+  """ paints the Form XObject xobj ontop of the page contents.
+      content_before and content_after are IndirectObjects of streams 
+      'q' and 'Q <name> Do', added once to output by the caller, see stamp_streams(). 
+      The page resources are copied, not modified, as pages often share them.
+  """
+  res = Pdf.DictionaryObject()
+  if '/Resources' in page: res.update(page['/Resources'])
+  xo = Pdf.DictionaryObject()
+  if '/XObject' in res: xo.update(res['/XObject'].getObject())
+  xo[Pdf.NameObject(name)] = xobj
+  res[Pdf.NameObject('/XObject')] = xo
+  page[Pdf.NameObject('/Resources')] = res
+
+  contents = Pdf.ArrayObject([content_before])
+  if '/Contents' in page:
+    c = page.raw_get('/Contents')
+    if isinstance(c.getObject(), Pdf.ArrayObject):
+      contents.extend(c.getObject())
+    elif isinstance(c, Pdf.IndirectObject):
+      contents.append(c)
+    else:
+      contents.append(output._addObject(c))
+  contents.append(content_after)
+  page[Pdf.NameObject('/Contents')] = contents
+
+def pdf_object_key(obj):
+  """ a hashable value, equal for PDF objects of equal contents. 
+      Indirect objects are compared by what they refer to.
+  """
+  obj = obj.getObject()
+  if isinstance(obj, Pdf.StreamObject):
+    return ('stream', pdf_object_key(Pdf.DictionaryObject(obj)), obj._data)
+  if isinstance(obj, dict):
+    return tuple(sorted([(k, pdf_object_key(v)) for k, v in obj.items()]))
+  if isinstance(obj, list):
+    return tuple([pdf_object_key(v) for v in obj])
+  return (obj.__class__.__name__, obj)
+
+def overlay_xobject(output, overlay, compress=True, resources=None):
+  """ turns the contents and resources of an overlay page into a Form XObject,
+      and adds it to output. The contents are decoded and flate encoded again,
+      as reportlab adds an ASCII85 layer.
+      resources is a dict, kept by the caller for all overlays: equal resource 
+      dictionaries (the fonts and graphics states of reportlab) are added 
+      to output only once, as the shared watermark_xobject() does.
+      Unlike mergePage(), stamp_xobject() then leaves the page contents untouched.
+  """
+  c = overlay['/Contents'].getObject()
+  form = Pdf.DecodedStreamObject()
+  if isinstance(c, Pdf.ArrayObject):
+    form.setData("\n".join([s.getObject().getData() for s in c]))
+  else:
+    form.setData(c.getData())
+  if compress: form = form.flateEncode()
+  res = overlay.get('/Resources', Pdf.DictionaryObject())
+  if resources is not None:
+    key = pdf_object_key(res)
+    if not key in resources:
+      resources[key] = output._addObject(res.getObject())
+    res = resources[key]
+  form[Pdf.NameObject('/Type')] = Pdf.NameObject('/XObject')
+  form[Pdf.NameObject('/Subtype')] = Pdf.NameObject('/Form')
+  form[Pdf.NameObject('/BBox')] = overlay['/MediaBox']
+  form[Pdf.NameObject('/Resources')] = res
+  return output._addObject(form)
+
+def pdf_startxref(infile):
+  """ returns the offset of the last cross-reference section of infile, 
+      and True if it is a cross-reference stream (PDF 1.5), not an xref table.
+  """
+  f = file(infile, "rb")
+  f.seek(0, 2)
+  f.seek(max(0, f.tell()-1024))
+  startxref = re.findall(r'startxref\s+(\d+)', f.read())
+  if not startxref: 
+    f.close()
+    raise Exception("no startxref in " + infile)
+  f.seek(int(startxref[-1]))
+  is_stream = not f.read(64).lstrip().startswith('xref')
+  f.close()
+  return (int(startxref[-1]), is_stream)
+
+def write_incremental(infile, outfile, reader, writer, info=None):
+  """ writes outfile as a byte copy of infile, followed by an incremental update:
+      the pages of writer (which must all come from reader, in order) are written
+      under their old object numbers, together with all objects they reference,
+      that are not already in infile. A new catalog points to the pages tree and
+      the outline of writer. The update has a classic xref table, infile must not 
+      use cross-reference streams, see pdf_startxref().
+      info is the new document info. It replaces the one of reader under its old 
+      number, or is added, if reader has none.
+      Returns the number of objects written.
+  """
+  import shutil
+  (startxref, xref_stream) = pdf_startxref(infile)
+  if xref_stream: raise Exception("write_incremental: %s has cross-reference streams" % infile)
+  shutil.copyfile(infile, outfile)
+
+  numbers = {}    # id(object) -> (idnum, generation) in outfile
+  todo = []
+  next_nr = [int(reader.trailer['/Size'])]
+  def number(obj):
+    if not id(obj) in numbers:
+      numbers[id(obj)] = (next_nr[0], 0)
+      next_nr[0] += 1
+      todo.append(obj)
+    return numbers[id(obj)]
+  def keep(ref, obj=None):
+    # an object of infile, that we modified. It keeps its number.
+    if obj is None: obj = ref.getObject()
+    numbers[id(obj)] = (ref.idnum, ref.generation)
+    todo.append(obj)
+
+  def translate(obj):
+    # a copy of obj, where all references point to numbers in outfile.
+    if isinstance(obj, Pdf.IndirectObject):
+      if obj.pdf is reader:
+        return obj      # unchanged, or written by keep() under the same number.
+      return Pdf.IndirectObject(*(number(obj.getObject()) + (None,)))
+    if isinstance(obj, Pdf.StreamObject):
+      # a direct stream, e.g. from compressContentStreams(). Not valid in PDF.
+      return Pdf.IndirectObject(*(number(obj) + (None,)))
+    if isinstance(obj, Pdf.DictionaryObject):
+      new = Pdf.DictionaryObject()
+      for k, v in obj.items(): new[k] = translate(v)
+      return new
+    if isinstance(obj, Pdf.ArrayObject):
+      return Pdf.ArrayObject([translate(v) for v in obj])
+    return obj
+
+  for ref in writer.getObject(writer._pages)['/Kids']:
+    page = ref.getObject()
+    keep(page.indirectRef, page)      # getPage() returns a copy of the page object.
+    annots = page.raw_get('/Annots') if '/Annots' in page else None
+    if isinstance(annots, Pdf.IndirectObject) and annots.pdf is reader:
+      keep(annots)      # mergeAnnotsRelocate() extends it in place.
+  catalog = Pdf.DictionaryObject()
+  catalog.update(reader.trailer['/Root'])
+  catalog[Pdf.NameObject('/Pages')] = writer._pages
+  if '/Outlines' in writer._root_object:
+    catalog[Pdf.NameObject('/Outlines')] = writer._root_object.raw_get('/Outlines')
+  root = reader.trailer.raw_get('/Root')
+  numbers[id(catalog)] = (root.idnum, root.generation)
+  todo.append(catalog)
+  trailer = Pdf.DictionaryObject()
+  trailer[Pdf.NameObject('/Root')] = Pdf.IndirectObject(root.idnum, root.generation, None)
+  old_info = reader.trailer.raw_get('/Info') if '/Info' in reader.trailer else None
+  if info is not None:
+    if isinstance(old_info, Pdf.IndirectObject):
+      keep(old_info, info)
+    else:
+      number(info)
+    trailer[Pdf.NameObject('/Info')] = Pdf.IndirectObject(*(numbers[id(info)] + (None,)))
+  elif isinstance(old_info, Pdf.IndirectObject):
+    trailer[Pdf.NameObject('/Info')] = Pdf.IndirectObject(old_info.idnum, old_info.generation, None)
+  if '/ID' in reader.trailer:
+    trailer[Pdf.NameObject('/ID')] = reader.trailer['/ID']
+
+  out = file(outfile, "ab+")
+  out.seek(-1, 2)
+  if out.read(1) != "\n": 
+    out.seek(0, 2)
+    out.write("\n")
+  out.seek(0, 2)
+  xref = {}
+  while todo:
+    obj = todo.pop(0)
+    nr, gen = numbers[id(obj)]
+    if isinstance(obj, Pdf.StreamObject):
+      new = Pdf.EncodedStreamObject() if '/Filter' in obj else Pdf.DecodedStreamObject()
+      for k, v in obj.items():
+        if k != '/Length': new[k] = translate(v)
+      new._data = obj._data
+    else:
+      new = translate(obj)
+    xref[nr] = (out.tell(), gen)
+    out.write("%d %d obj\n" % (nr, gen))
+    new.writeToStream(out, None)
+    out.write("\nendobj\n")
+
+  xref_pos = out.tell()
+  out.write("xref\n0 1\n0000000000 65535 f \n")
+  nrs = sorted(xref.keys())
+  while nrs:
+    n = 1
+    while n < len(nrs) and nrs[n] == nrs[0]+n: n += 1
+    out.write("%d %d\n" % (nrs[0], n))
+    for nr in nrs[:n]:
+      out.write("%010d %05d n \n" % xref[nr])
+    nrs = nrs[n:]
+  trailer[Pdf.NameObject('/Size')] = Pdf.NumberObject(next_nr[0])
+  trailer[Pdf.NameObject('/Prev')] = Pdf.NumberObject(startxref)
+  out.write("trailer\n")
+  trailer.writeToStream(out, None)
+  out.write("\nstartxref\n%d\n%%%%EOF\n" % xref_pos)
+  out.close()
+  return len(xref)
+
 
 # import xml.etree.ElementTree as pET
 # class RelaxedXMLParser(pET.XMLParser):
@@ -413,7 +755,117 @@ def page_watermark(canv, box, argv, color=[1,0,1], trans=0.5, p_w=None, p_h=None
 #     super(RelaxedXMLParser,self).feed(data)
 
 
-def pdf2xml(parser, infile, key='', firstpage=None, lastpage=None):
+def pdf_num_pages(infile, key=''):
+  """ ask pdfinfo (poppler-tools, same package as pdftohtml) for the number
+      of pages in infile. Returns None if pdfinfo is not available or fails;
+      callers then fall back to a single pdftohtml run.
+  """
+  pdfinfo_cmd = ["pdfinfo"]
+  if len(key):
+    pdfinfo_cmd += ["-upw", key]
+  try:
+    out = subprocess.Popen(pdfinfo_cmd + [infile], stdout=subprocess.PIPE,
+                           stderr=open(os.devnull, 'w')).communicate()[0]
+  except OSError:
+    return None
+  m = re.search("^Pages:\s+(\d+)", out, re.M)
+  if m:
+    return int(m.group(1))
+  return None
+
+def pdf2xml_ranges(firstpage, lastpage, npages, chunk_pages=None, jobs=1):
+  """ split the page range firstpage..lastpage (counting from 1, inclusive,
+      None means open ended, as with pdftohtml -f -l) into chunks of
+      chunk_pages pages, returning a list of (firstpage, lastpage) tuples.
+      chunk_pages=None picks a chunk size that keeps all jobs busy, 
+      chunk_pages=0 disables chunking. A document with an unknown number 
+      of pages (npages=None) is never split.
+  """
+  if npages is None or chunk_pages == 0:
+    return [(firstpage, lastpage)]
+  f = 1
+  if firstpage is not None: f = int(firstpage)
+  l = npages
+  if lastpage is not None and int(lastpage) < l: l = int(lastpage)
+  if chunk_pages is None:
+    chunk_pages = max(pdf2xml_min_chunk, -(-(l-f+1)//max(1,jobs)))
+  if l-f+1 <= chunk_pages:
+    return [(firstpage, lastpage)]
+  r = []
+  while f <= l:
+    r.append((str(f), str(min(f+chunk_pages-1, l))))
+    f += chunk_pages
+  return r
+
+def pdftohtml_run(cmd):
+  """ run one pdftohtml -xml command and collect its output in a temporary
+      file. Returns the file name; the caller is responsible for removing it.
+      This is the worker function for pdf2xml_start(), several of these 
+      run in parallel.
+  """
+  (fd, tmpname) = tempfile.mkstemp(prefix='pdf2xml_', suffix='.xml')
+  out = os.fdopen(fd, 'wb')
+  try:
+    subprocess.Popen(cmd, stdout=out).wait()
+  except:
+    out.close()
+    os.unlink(tmpname)
+    raise
+  out.close()
+  return tmpname
+
+def pdf2xml_start(infile, key='', firstpage=None, lastpage=None, pool=None, chunk_pages=None, jobs=1):
+  """ start pdftohtml -xml for infile in the background, split into page 
+      range chunks, if the document is large. The chunks are handed to pool,
+      a multiprocessing.pool.ThreadPool; the threads only wait for the 
+      pdftohtml processes, so they run truly in parallel.
+      Returns a job handle to be passed to pdf2xml_collect().
+  """
+  pdftohtml_cmd = ["pdftohtml", "-q", "-i", "-nodrm", "-nomerge", "-stdout", "-xml"]
+  if len(key):
+    pdftohtml_cmd += ["-upw", key]
+  npages = None
+  if chunk_pages != 0:
+    npages = pdf_num_pages(infile, key)
+  if pool is None:
+    pool = ThreadPool(1)
+  chunks = []
+  for (f, l) in pdf2xml_ranges(firstpage, lastpage, npages, chunk_pages, jobs):
+    cmd = list(pdftohtml_cmd)
+    if f is not None:
+      cmd += ["-f", f]
+    if l is not None:
+      cmd += ["-l", l]
+    cmd += [infile]
+    chunks.append((cmd, pool.apply_async(pdftohtml_run, (cmd,))))
+  if len(chunks) > 1:
+    print("pdf2xml %s: %d chunks" % (infile, len(chunks)))
+  return chunks
+
+def pdf2xml_collect(parser, chunks):
+  """ wait for the pdftohtml processes started by pdf2xml_start(), parse 
+      their output and stitch the chunks together into one dom tree.
+      The first parameter, parser is only used for calling exit() with proper messages.
+  """
+  doms = []
+  for (cmd, result) in chunks:
+    try:
+      tmpname = result.get()
+    except Exception as e:
+      print(" ".join(cmd))
+      parser.exit("pdftohtml -xml failed: " + " ".join(cmd) + ": " + str(e))
+    try:
+      dom = do_pdf2xml(parser, cmd, tmpname, relaxed=False)
+      if dom is None:
+        print(" pdf2xml retrying more relaxed ...")
+        dom = do_pdf2xml(parser, cmd, tmpname, relaxed=True)
+    finally:
+      os.unlink(tmpname)
+    doms.append(dom)
+  print("pdf2xml done")
+  return pdf2xml_stitch(doms)
+
+def pdf2xml(parser, infile, key='', firstpage=None, lastpage=None, pool=None, chunk_pages=None, jobs=1):
   """ read a pdf file with pdftohtml and parse the resulting xml into a dom tree
       the first parameter, parser is only used for calling exit() with proper messages.
 
@@ -421,60 +873,179 @@ def pdf2xml(parser, infile, key='', firstpage=None, lastpage=None):
       consuming, but irrelevant, considered the slowness of SequenceMatcher...)
       is attemted, if the normal cElementTree parser fails.
       This compensates for a bug in pdftohtml -xml yielding invalid xml.
+
+      Large documents are split into page range chunks, that are extracted 
+      in parallel, see pdf2xml_start().
   """
-  dom = do_pdf2xml(parser, infile, key=key, firstpage=firstpage, lastpage=lastpage, relaxed=False)
-  if dom is None:
-    print(" pdf2xml retrying more relaxed ...")
-    dom = do_pdf2xml(parser, infile, key=key, firstpage=firstpage, lastpage=lastpage, relaxed=True)
-  return dom
+  return pdf2xml_collect(parser, pdf2xml_start(infile, key=key, firstpage=firstpage, lastpage=lastpage,
+                                               pool=pool, chunk_pages=chunk_pages, jobs=jobs))
 
-def do_pdf2xml(parser, infile, key='', firstpage=None, lastpage=None, relaxed=False):
-  """ read a pdf file with pdftohtml and parse the resulting xml into a dom tree
+def do_pdf2xml(parser, cmd, xmlfile, relaxed=False):
+  """ parse the xml output of a pdftohtml command cmd, found in xmlfile into a dom tree
       the first parameter, parser is only used for calling exit() with proper messages.
 
       CAUTION: this uses pdftohtml -xml, which may return invalid xml. A workaround
       for some cases is provided, if relaxed=True.
   """
-  pdftohtml_cmd = ["pdftohtml", "-q", "-i", "-nodrm", "-nomerge", "-stdout", "-xml"]
-  if firstpage is not None:
-    pdftohtml_cmd += ["-f", firstpage]
-  if lastpage is not None:
-    pdftohtml_cmd += ["-l", lastpage]
-  if len(key):
-    pdftohtml_cmd += ["-upw", key]
-  try:
-    (to_child, from_child) = os.popen2(pdftohtml_cmd + [infile])
-  except Exception as e:
-    print(" ".join(pdftohtml_cmd + [infile]))
-    parser.exit("pdftohtml -xml failed: " + " ".join(pdftohtml_cmd + [infile]) + ": " + str(e))
-
   try:
     if relaxed:
-      data = from_child.read()
+      data = open(xmlfile, 'rb').read()
       data = re.sub("(<a.*?>|</a>)","", data)      # <a...> </a> appear to be misplaced.
       dom = ET.parse(StringIO(data))
     else:
-      dom = ET.parse(from_child)
+      dom = ET.parse(xmlfile)
   except Exception as e:
-    print(" ".join(pdftohtml_cmd + [infile]))
+    print(" ".join(cmd))
     if relaxed:
       parser.exit("pdftohtml -xml failed.\nET.parse: " + str(e) + ")\n\n" + parser.format_usage())
     else:
       return None
-  print("pdf2xml done")
   return dom
 
+class FontspecRenumber():
+  """pdftohtml -xml numbers the fonts of a document in order of their first 
+     appearance, and emits a <fontspec> element only on the page where a font
+     is first used. Each page range chunk of a document restarts this 
+     numbering at 0. FontspecRenumber maps the chunk local font ids back to 
+     the ids a single pdftohtml run would have assigned: A font that was seen 
+     in an earlier chunk gets its old id, and its repeated <fontspec> is 
+     removed. Fonts are identified by their fontspec attributes (except id).
+     If a chunk has multiple fonts with identical attributes, they are paired
+     in order of appearance.
+  """
+  def __init__(self):
+    self.ids = {}       # fontspec attributes -> list of global ids
+    self.next_id = 0
+
+  def chunk(self):
+    """ call this before the first page of each chunk. """
+    self.local = {}     # chunk local id -> global id
+    self.seen = {}      # fontspec attributes -> count seen in this chunk
+
+  def page(self, p):
+    """ renumber the fontspec and text elements of a page element in place. """
+    prev = None
+    for fspec in list(p):
+      if fspec.tag != 'fontspec':
+        prev = fspec
+        continue
+      key = tuple(sorted([kv for kv in fspec.attrib.items() if kv[0] != 'id']))
+      n = self.seen.get(key, 0)
+      self.seen[key] = n + 1
+      known = self.ids.setdefault(key, [])
+      if n < len(known):
+        self.local[fspec.attrib.get('id')] = known[n]
+        # keep the whitespace layout of a single run intact.
+        if prev is None: p.text = fspec.tail
+        else:            prev.tail = fspec.tail
+        p.remove(fspec)
+      else:
+        prev = fspec
+        g_id = str(self.next_id)
+        self.next_id += 1
+        known.append(g_id)
+        self.local[fspec.attrib.get('id')] = g_id
+        fspec.set('id', g_id)
+    for e in p.findall('text'):
+      f_id = e.attrib.get('font')
+      if f_id in self.local:
+        e.set('font', self.local[f_id])
+
+def pdf2xml_stitch(doms):
+  """ merge the dom trees of page range chunks of a document into one,
+      as if the document was converted in a single pdftohtml run.
+      Other elements than pages (e.g. the outline) are only taken from the 
+      first chunk, they are document wide and repeat in each chunk.
+  """
+  if len(doms) == 1:
+    return doms[0]
+  root = doms[0].getroot()
+  tail = [e for e in root if e.tag != 'page']
+  for e in tail:
+    root.remove(e)
+  renumber = FontspecRenumber()
+  for dom in doms:
+    renumber.chunk()
+    for p in dom.getroot().findall('page'):
+      renumber.page(p)
+      if dom is not doms[0]:
+        root.append(p)
+  for e in tail:
+    root.append(e)
+  return doms[0]
+
+def iterparse_pages(source):
+  """ yields the page elements of pdftohtml -xml output read from source,
+      without ever building the full dom tree. A page element is cleared,
+      when the next one is requested.
+  """
+  context = iter(ET.iterparse(source, events=("start", "end")))
+  event, root = next(context)
+  for event, elem in context:
+    if event == "end" and elem.tag == 'page':
+      yield elem
+      root.clear()      # drops elem and everything before it.
+
+def pdf2xml_pages(parser, chunks):
+  """ streaming variant of pdf2xml_collect(): waits for the pdftohtml processes
+      started by pdf2xml_start(), and yields their page elements in document order,
+      with fontspec ids renumbered as in pdf2xml_stitch(). 
+      The pages are parsed with iterparse() and cleared after use, so that memory 
+      grows with the page size rather than the document size.
+      The first parameter, parser is only used for calling exit() with proper messages.
+  """
+  chunks = list(chunks)
+  renumber = FontspecRenumber()
+  try:
+    while len(chunks):
+      (cmd, result) = chunks.pop(0)
+      try:
+        tmpname = result.get()
+      except Exception as e:
+        print(" ".join(cmd))
+        parser.exit("pdftohtml -xml failed: " + " ".join(cmd) + ": " + str(e))
+      renumber.chunk()
+      last_nr = None
+      try:
+        try:
+          for p in iterparse_pages(open(tmpname, 'rb')):
+            renumber.page(p)
+            last_nr = p.attrib.get('number')
+            yield p
+        except SyntaxError:
+          # ET.ParseError. We already yielded some pages, continue after those.
+          print(" pdf2xml retrying more relaxed ...")
+          dom = do_pdf2xml(parser, cmd, tmpname, relaxed=True)
+          skip = last_nr is not None
+          for p in dom.findall('page'):
+            if skip:
+              if p.attrib.get('number') == last_nr: skip = False
+              continue
+            renumber.page(p)
+            yield p
+      finally:
+        os.unlink(tmpname)
+    print("pdf2xml done")
+  finally:
+    # the consumer stopped early (e.g. at last_page): clean up.
+    for (cmd, result) in chunks:
+      try:
+        os.unlink(result.get())
+      except Exception:
+        pass
+
 class DecoratedWord(list):
   """Usage in pdfcompare is:
      word[0] is the word itself; word[1] is a longer string, where word[0] is
      found; word[2] is the index position into word[1], and word[3] is a set of
      attributes, as follows:
      Elements of word[3] are:
-     {'f': '3', 's':'stem', 'h': '10', 'l': 'b', 'p': 2, 'w': '151', 'x': '540', 'y': '1209'}
+     {'f': 3, 'h': 10.0, 'l': 'b', 'p': 2, 'w': 151.0, 'x': 540.0, 'y': 1209.0}
      Where f is the font index; l is the location on the page as in t(op),
      m(iddle), b(ottom); p is the physical page number; x,y,w,h define the
-     bounding box of word[1]; and s is a substring (without digits or
-     punctuation) used for spell checking.
+     bounding box of word[1].
+     WordTable stores words in a more compact way, and returns a 
+     DecoratedWord when indexed.
   """
 
   def __eq__(self, other):
@@ -483,10 +1054,188 @@ class DecoratedWord(list):
   def __hash__(self):
     return hash(self[0])
 
-def xmlfile2wordlist(fname):
+class WordInterner(dict):
+  """maps each distinct word string to a compact integer id.
+     Use one instance for both documents of a comparison, so that equal words
+     get equal ids. The ids() of a wordlist are what the diff engines compare:
+     plain integers hash and compare much faster than DecoratedWord, whose
+     __eq__ and __hash__ are python methods.
+     self.strings maps the ids back to the words.
+  """
+  def __init__(self):
+    dict.__init__(self)
+    self.strings = []
+
+  def intern(self, word):
+    i = self.get(word)
+    if i is None:
+      i = self[word] = len(self.strings)
+      self.strings.append(word)
+    return i
+
+  def ids(self, wordlist):
+    """ returns an array('i') with the ids of all words in wordlist. 
+        New words are added to the interner on the fly.
+        A WordTable that uses this interner already has them.
+    """
+    if isinstance(wordlist, WordTable) and wordlist.interner is self:
+      return wordlist.tok
+    r = array('i')
+    for w in wordlist:
+      r.append(self.intern(w[0]))
+    return r
+
+class WordTable():
+  """A column oriented wordlist. Compared to a list of DecoratedWord, 
+     this needs a fraction of the memory, and all coordinates are parsed 
+     into floats exactly once.
+     Per word, we have arrays with the token id (see WordInterner), the 
+     text run id, the char offset into the text run, the physical page 
+     number and the location on the page (t(op), c(enter), b(ottom)).
+     Per text run, we have the text string, x, y, w, h as floats and the
+     font id.
+     Words from .txt or .xml files have no text run, but a line 
+     number (and an element count).
+     Indexing a WordTable returns a DecoratedWord, so that it can still 
+     be used like a list of DecoratedWord. The diff and mark code uses the
+     columns directly.
+  """
+  loc_names = ('', 't', 'c', 'b')
+  columns = ('tok', 'run', 'off', 'page', 'loc', 'line', 'elem', 'x', 'y', 'w', 'h', 'font')
+
+  def __init__(self, interner=None):
+    if interner is None: interner = WordInterner()
+    self.interner = interner
+    # per word
+    self.tok  = array('i')
+    self.run  = array('i')
+    self.off  = array('i')
+    self.page = array('i')
+    self.loc  = array('b')
+    self.line = array('i')      # only with words from .txt or .xml
+    self.elem = array('i')      # only with words from .xml
+    # per text run
+    self.text = []
+    self.x    = array('d')
+    self.y    = array('d')
+    self.w    = array('d')
+    self.h    = array('d')
+    self.font = array('i')
+
+  def __len__(self):
+    return len(self.tok)
+
+  def __getitem__(self, i):
+    if isinstance(i, slice):
+      return [self[k] for k in range(*i.indices(len(self)))]
+    if i < 0: i += len(self)
+    r = self.run[i]
+    if r < 0:
+      return DecoratedWord([self.word(i), None, None, self.context(i)])
+    return DecoratedWord([self.word(i), self.text[r], self.off[i], self.context(i)])
+
+  def word(self, i):
+    return self.interner.strings[self.tok[i]]
+
+  def page_nr(self, i):
+    """ the physical page number of word i, or None """
+    return self.page[i] or None
+
+  def run_y(self, i):
+    """ the y coordinate of the text run of word i, or None """
+    r = self.run[i]
+    if r < 0: return None
+    return self.y[r]
+
+  def context(self, i):
+    """ returns the attributes of word i, as word[3] of a DecoratedWord. """
+    r = self.run[i]
+    if r < 0:
+      c = {'l':self.line[i]}
+      if len(self.elem): c['e'] = self.elem[i]
+      return c
+    return {'p':self.page[i], 'l':self.loc_names[self.loc[i]], 'f':self.font[r],
+            'x':self.x[r], 'y':self.y[r], 'w':self.w[r], 'h':self.h[r]}
+
+  def location(self, i):
+    """ a short text telling where word i is: page or element and 
+        location or line number, e.g. 'p3t' or 'e12l5'
+    """
+    if self.page[i]:
+      page_or_elem = 'p'+str(self.page[i])
+    elif len(self.elem) and self.elem[i]:
+      page_or_elem = 'e'+str(self.elem[i])
+    else:
+      page_or_elem = '#'
+    if self.run[i] < 0:
+      return page_or_elem + 'l'+str(self.line[i])
+    return page_or_elem + self.loc_names[self.loc[i]]
+
+  def add_word(self, word, line=0, elem=None):
+    """ adds a word without a text run, as read from .txt or .xml files. """
+    self.tok.append(self.interner.intern(word))
+    self.run.append(-1)
+    self.off.append(-1)
+    self.page.append(0)
+    self.loc.append(0)
+    self.line.append(line)
+    if elem is not None: self.elem.append(elem)
+
+  def add_textline(self, text, p_nr, loc, x, y, w, h, font, bbox=None):
+    """adds a text run and all its words.
+       words are defined as any printable text delimited by whitespace.
+       just as str.split() would do.
+
+       A bbox (x1,y1, x2, y2) with x1 < x2, y1 < y2 can be specified to prefilter
+       the words. Only words that are (at least partially) inside the bbox
+       will be added.
+    """
+    r = len(self.text)
+    self.text.append(text)
+    self.x.append(x)
+    self.y.append(y)
+    self.w.append(w)
+    self.h.append(h)
+    self.font.append(font)
+    context = None
+    if bbox is not None and not bbox_inside(bbox, [x,y,x+w,y+h]):
+      context = {'x':x, 'y':y, 'w':w, 'h':h}
+    loc = self.loc_names.index(loc)
+    for (head, idx) in textline_split(text):
+      if context is not None and not in_bbox_interpolated(bbox, [head, text, idx, context]):
+        continue
+      self.tok.append(self.interner.intern(head))
+      self.run.append(r)
+      self.off.append(idx)
+      self.page.append(p_nr)
+      self.loc.append(loc)
+
+  def tostring(self):
+    """ a compact binary representation of the table and its interner, 
+        for the extraction cache. See fromstring().
+    """
+    cols = dict([(c, getattr(self, c).tostring()) for c in self.columns])
+    return zlib.compress(marshal.dumps({'byteorder': sys.byteorder, 'columns': cols,
+                                        'text': self.text, 'strings': self.interner.strings}), 1)
+
+  @classmethod
+  def fromstring(cls, data):
+    """ the inverse of tostring(). The table gets a new interner with its own words. """
+    d = marshal.loads(zlib.decompress(data))
+    if d['byteorder'] != sys.byteorder: raise ValueError("byteorder " + d['byteorder'])
+    interner = WordInterner()
+    interner.strings = d['strings']
+    interner.update([(w, i) for i, w in enumerate(interner.strings)])
+    wl = cls(interner)
+    wl.text = d['text']
+    for c in cls.columns:
+      getattr(wl, c).fromstring(d['columns'][c])
+    return wl
+
+def xmlfile2wordlist(fname, interner=None):
   """ works well with xml from pdftohtml -xml.
       """
-  wl = []
+  wl = WordTable(interner)
   elementcount = 0
 
   #tree= ET.parse(fname)
@@ -513,20 +1262,20 @@ def xmlfile2wordlist(fname):
       # t = "".join(elem.itertext())
       if elem.text:
         for w in elem.text.split():
-          wl.append(DecoratedWord([w,None,None,{'e':elementcount, 'l':f.lineno}]))
+          wl.add_word(w, f.lineno, elementcount)
   return wl
 
-def textfile2wordlist(fname):
+def textfile2wordlist(fname, interner=None):
   """ CAUTION if you create your text files with pdftotxt, 
       things may appear in different ordering than with pdftohtml, resulting
       in an enormous diff.
       """
-  wl = []
+  wl = WordTable(interner)
   # assume .txt files are utf8 encoded, but please survive binary garbage.
   with codecs.open(fname, 'r', 'utf-8', errors='ignore') as f:
     for lnr, line in enumerate(f):
       for w in line.split():
-        wl.append(DecoratedWord([w,None,None,{'l':lnr}]))
+        wl.add_word(w, lnr)
   return wl
 
 def bbox_inside(bb1, bb2):
@@ -598,44 +1347,68 @@ def in_bbox_interpolated(bbox, word):
     return True         
   return False
   
-def textline2wordlist(text, context, bbox=None):
-  """returns a list of 4-element lists like this:
-     [word, text, idx, context]
-     where the word was found in the text string at offset idx.
-     words are defined as any printable text delimited by whitespace.
-     just as str.split() would do.
-     Those 4-element lists are cast into DecoratedWord.
-     The DecoratedWord type extends the list type, so that it is hashable and
-     comparable using only the "word" which is the first element of the four. 
-     Thus our wordlists work well as sequences with difflib, although they also
-     transport all the context to compute exact page positions later.
-
-     A bbox (x1,y1, x2, y2) with x1 < x2, y1 < y2 can be specified to prefilter
-     the wordlist. Only words that are (at least partially) inside the bbox
-     will be returned.
-  """
-
-  wl = []
+def textline_split(text):
+  """yields (word, idx) tuples, where the word was found in the text 
+     string at offset idx. Words are defined as any printable text 
+     delimited by whitespace. just as str.split() would do.
+  """
   idx = 0
   tl = re.split("(\s+)", text)
-  while True:
-    if len(tl)==0: break
-    head = tl.pop(0)
+  for k in range(0, len(tl), 2):
+    head = tl[k]
     if len(head):
-      word = [head, text, idx, context]
-      if in_bbox_interpolated(bbox, word):
-        wl.append(DecoratedWord(word))
-    if len(tl)==0: break
-    sep = tl.pop(0)
-    idx += len(sep)+len(head)
-  return wl
+      yield (head, idx)
+    if k+1 < len(tl):
+      idx += len(tl[k+1])+len(head)
   
-def xml2wordlist(dom, first_page=None, last_page=None, margins=None):
-  """input: a dom tree as generated by pdftohtml -xml.
+def dom_pages(dom):
+  """ returns the page elements of a dom tree as generated by pdftohtml -xml.
+      dom may also be an iterable of page elements, as yielded by pdf2xml_pages().
+  """
+  if hasattr(dom, 'findall'):
+    return dom.findall('page')
+  return dom
+
+def xml_page_wordlist(p, p_nr, margins=None, wl=None):
+  """input: a page element of a dom tree as generated by pdftohtml -xml.
+     p_nr is the physical page number, starting at 1. 
+     The words are appended to the WordTable wl, a new one is created if None.
+     See xml2wordlist() for details.
+  """
+  if wl is None: wl = WordTable()
+  p_h = float(p.attrib['height'])
+  p_w = float(p.attrib['width'])
+
+  # default bounding box is entire page:
+  # bbox ordering is x1,y1, x2, y2 where x1,y1 are the smaller values.
+  p_bbox = (0, 0, p_w, p_h)
+  if margins is not None:
+    p_bbox = (margins['n'], margins['w'], p_w - margins['e'], p_h - margins['s'])
+
+  for e in p.findall('text'):
+    # <text font="0" height="19" left="54" top="107" width="87"><b>Features</b></text>
+    x=float(e.attrib['left'])
+    y=float(e.attrib['top'])
+    w=float(e.attrib['width'])
+    h=float(e.attrib['height'])
+    f=int(e.attrib['font'])
+    text = ''
+    for t in e.itertext(): text += t
+
+    ## crude top,center,bottom location
+    if   y > 0.66*p_h: l = 'b'
+    elif y > 0.33*p_h: l = 'c'
+    else:              l = 't'
+    wl.add_textline(text, p_nr, l, x, y, w, h, f, p_bbox)
+  return wl
+
+def xml2wordlist(dom, first_page=None, last_page=None, margins=None, interner=None):
+  """input: a dom tree as generated by pdftohtml -xml, or an iterable of its 
+     page elements (see dom_pages()).
      first_page, last_page start counting at 0.
      If margins is not None, the coordinates of all words are filtered against 
      a bounding box constructed by reducing the page box.
-     output: a wordlist with all the metadata so that the exact coordinates
+     output: a WordTable with all the metadata so that the exact coordinates
              of each word can be calculated.
   """
   ## Caution: 
@@ -646,74 +1419,213 @@ def xml2wordlist(dom, first_page=None, last_page=None, margins=None):
   ## Seen in atmega164_324_644_1284_8272S.pdf
 
   if first_page is None: first_page = 0
-  wl=[]
+  wl = WordTable(interner)
   p_nr = 0
-  for p in dom.findall('page'):
+  for p in dom_pages(dom):
     if not last_page is None:
       if p_nr > int(last_page):
         break
     p_nr += 1
     if p_nr <= int(first_page):
       continue
-    p_h = float(p.attrib['height'])
-    p_w = float(p.attrib['width'])
-
-    # default bounding box is entire page:
-    # bbox ordering is x1,y1, x2, y2 where x1,y1 are the smaller values.
-    p_bbox = (0, 0, p_w, p_h)
-    if margins is not None:
-      p_bbox = (margins['n'], margins['w'], p_w - margins['e'], p_h - margins['s'])
-
-    for e in p.findall('text'):
-      # <text font="0" height="19" left="54" top="107" width="87"><b>Features</b></text>
-      x=e.attrib['left']
-      y=e.attrib['top']
-      w=e.attrib['width']
-      h=e.attrib['height']
-      f=e.attrib['font']
-      text = ''
-      for t in e.itertext(): text += t
-
-      ## crude top,center,bottom location
-      if   float(y) > 0.66*p_h: l = 'b'
-      elif float(y) > 0.33*p_h: l = 'c'
-      else:                     l = 't'
-      wl += textline2wordlist(text, {'p':p_nr, 'l':l, 'x':x, 'y':y, 'w':w, 'h':h, 'f':f}, p_bbox)
+    xml_page_wordlist(p, p_nr, margins, wl)
     #pprint(wl)
   print("xml2wordlist: %d pages" % (p_nr-int(first_page)))
   return wl
 
+def wordlist_cache_key(fname, first_page=None, last_page=None, margins=None):
+  """ identifies the result of xml2wordlist() for a pdf file: a hash of the
+      file contents, the page range and the margins. The file name and 
+      mtime do not matter, a renamed or copied release still hits.
+  """
+  h = hashlib.sha1()
+  with open(fname, 'rb') as f:
+    for block in iter(lambda: f.read(1<<20), ''):
+      h.update(block)
+  m = None
+  if margins is not None: m = [margins[k] for k in 'news']
+  h.update(repr((wordlist_cache_version, first_page, last_page, m)))
+  return h.hexdigest()
+
+def wordlist_cache_get(cache_dir, key):
+  """ returns the WordTable stored under key in cache_dir, or None. 
+      A hit touches the entry, see wordlist_cache_put().
+  """
+  fname = os.path.join(cache_dir, key + '.wt')
+  try:
+    with open(fname, 'rb') as f:
+      wl = WordTable.fromstring(f.read())
+    os.utime(fname, None)
+  except (IOError, OSError, ValueError, EOFError, KeyError, zlib.error) as e:
+    if not isinstance(e, IOError) or os.path.exists(fname):
+      print("wordlist cache %s ignored: %s" % (fname, e))
+    return None
+  return wl
+
+def wordlist_cache_put(cache_dir, key, wl, max_bytes=None):
+  """ stores the WordTable wl under key in cache_dir. Then the least recently 
+      used entries are removed, until the cache is no larger than max_bytes.
+  """
+  if max_bytes is None: max_bytes = wordlist_cache_max
+  fname = os.path.join(cache_dir, key + '.wt')
+  try:
+    if not os.path.isdir(cache_dir): os.makedirs(cache_dir)
+    with open(fname + '.tmp', 'wb') as f:
+      f.write(wl.tostring())
+    os.rename(fname + '.tmp', fname)
+    entries = []
+    for n in os.listdir(cache_dir):
+      if n.endswith('.wt'):
+        st = os.stat(os.path.join(cache_dir, n))
+        entries.append((st.st_mtime, st.st_size, n))
+    entries.sort()
+    total = sum([e[1] for e in entries])
+    while total > max_bytes and len(entries) > 1:
+      (mtime, size, n) = entries.pop(0)
+      os.unlink(os.path.join(cache_dir, n))
+      total -= size
+  except (IOError, OSError) as e:
+    print("wordlist cache %s not written: %s" % (fname, e))
+
+metrics_backends = ('pygame', 'ttf', 'afm')
+metrics_backend = 'pygame'      # see --metrics
+font_files = {}         # family -> font file, as found by match_font()
+font_cache = {}         # font_key() -> FontAdvances, shared by all pages
+font_metrics_disk = {}  # font_key() -> glyph advances, see font_metrics_load()
+
+def pygame_font():
+  """ returns the pygame.font module, imported and initialized on first use. """
+  global PGF
+  if PGF is None:
+    import pygame.font as PGF
+    PGF.init()
+  return PGF
+
+def match_font(family):
+  """ returns the font file for family, or None. Asks PGF.match_font()
+      or fc-match, once per family.
+  """
+  if not family in font_files:
+    f_file = None
+    if metrics_backend == 'pygame':
+      f_file = pygame_font().match_font(family)
+    elif metrics_backend == 'ttf':
+      try:
+        f_file = subprocess.Popen(['fc-match', '-f', '%{file}', family], 
+                   stdout=subprocess.PIPE).communicate()[0].strip() or None
+      except OSError:
+        pass
+    font_files[family] = f_file
+  return font_files[family]
+
+def font_key(family, size):
+  if metrics_backend == 'afm':
+    return ('afm', afm_font_name(family), size)
+  return (metrics_backend, match_font(family) or family, size)
+
+def load_font(family, size):
+  """ returns the FontAdvances for font family and size.
+      The font file is looked up once per family, and each font is loaded once.
+      The font is not even opened, as long as all glyph advances 
+      needed are known from the disk cache.
+  """
+  key = font_key(family, size)
+  f = font_cache.get(key)
+  if f is None:
+    f = font_cache[key] = FontAdvances(family=family, file=match_font(family), size=size)
+    f.adv.update(font_metrics_disk.get(key, {}))
+  return f
+
+def font_mtime(f_file):
+  try:
+    return os.path.getmtime(f_file)
+  except (OSError, TypeError):
+    return None
+
+def font_metrics_load(fname):
+  """ reads font file names and glyph advances as written by font_metrics_save().
+      Fonts whose file has changed since are ignored.
+  """
+  if not os.path.exists(fname): return
+  try:
+    with open(fname) as f:
+      data = json.load(f)
+  except (IOError, ValueError) as e:
+    print("font metrics cache %s ignored: %s" % (fname, e))
+    return
+  if data.get('metrics') != metrics_backend: return
+  for family, f_file in data.get('match_font', {}).items():
+    if f_file is None or os.path.exists(f_file):
+      font_files[family] = f_file
+  for backend, name, size, mtime, adv in data.get('advances', []):
+    if font_mtime(name) == mtime:
+      font_metrics_disk[(backend, name, size)] = adv
+
+def font_metrics_save(fname):
+  """ writes the font file names and all glyph advances known to fname, 
+      in JSON format. Together with font_metrics_load() this skips the font 
+      resolution in repeated runs.
+  """
+  adv = dict(font_metrics_disk)
+  for key in font_cache:
+    adv[key] = font_cache[key].adv
+  data = {'metrics': metrics_backend, 'match_font': font_files, 
+          'advances': [[k[0], k[1], k[2], font_mtime(k[1]), adv[k]] for k in adv]}
+  try:
+    with open(fname + '.tmp', 'w') as f:
+      json.dump(data, f)
+    os.rename(fname + '.tmp', fname)
+  except (IOError, OSError, UnicodeDecodeError) as e:
+    print("font metrics cache %s not written: %s" % (fname, e))
+
+def xml_page_fontinfo(p, p_finfo):
+  """ returns the font dict for page element p. This is p_finfo itself, 
+      if p has no fontspec elements, otherwise a copy of p_finfo updated 
+      with them. See xml2fontinfo().
+  """
+  fspecs = [(fspec.attrib.get('id'), fspec.attrib.get('family', 'Helvetica'), fspec.attrib.get('size', 12))
+            for fspec in p.findall('fontspec')]
+  # print("----------------- page %s -----------------" % p.attrib['number'])
+  return page_fontinfo(p_finfo, fspecs)
+
+def page_fontinfo(p_finfo, fspecs):
+  """ returns p_finfo, or a copy of it updated with the fonts in fspecs, 
+      a list of (id, family, size) tuples.
+  """
+  if not len(fspecs): return p_finfo
+  p_finfo = p_finfo.copy()
+  for f_id, fname, fsize in fspecs:
+    ######
+    # On openSUSE 12.1 Beta 1 (i586,fossy) the call to PGF.Font() triggers this warning:
+    # /usr/lib/python2.7/site-packages/pygame/pkgdata.py:27: UserWarning:
+    # Module argparse was already imported from
+    # /usr/lib/python2.7/argparse.pyc, but /usr/lib/python2.7/site-packages
+    # is being added
+    f = load_font(fname, int(0.5+float(fsize)))
+    p_finfo[int(f_id)] = { 'name': fname, 'size':fsize, 'file': f.file, 'font':f }
+  #pprint(p_finfo)
+  return p_finfo
+
 def xml2fontinfo(dom, last_page=None):
   # last_page starts counting at 0 and is inclusive.
   finfo = [None]      # each page may add (or overwrite?) some fonts
   p_finfo = {}
   p_nr = 0
-  for p in dom.findall('page'):
+  for p in dom_pages(dom):
     if not last_page is None:
       if p_nr > int(last_page):
         break
     p_nr += 1
-    p_finfo = p_finfo.copy()
-    # print("----------------- page %s -----------------" % p.attrib['number'])
-
-    for fspec in p.findall('fontspec'):
-      fname = fspec.attrib.get('family', 'Helvetica')
-      fsize = fspec.attrib.get('size', 12)
-      f_id  = fspec.attrib.get('id')
-      f_file = PGF.match_font(fname)
-      ######
-      # On openSUSE 12.1 Beta 1 (i586,fossy) the call to PGF.Font() triggers this warning:
-      # /usr/lib/python2.7/site-packages/pygame/pkgdata.py:27: UserWarning:
-      # Module argparse was already imported from
-      # /usr/lib/python2.7/argparse.pyc, but /usr/lib/python2.7/site-packages
-      # is being added
-      f = PGF.Font(f_file, int(0.5+float(fsize)))
-      p_finfo[f_id] = { 'name': fname, 'size':fsize, 'file': f_file, 'font':f }
-    #pprint(p_finfo)
+    p_finfo = xml_page_fontinfo(p, p_finfo)
     finfo.append(p_finfo)
   return finfo
 
-def main():
+def main(argv=None, stats=None):
+  """ the command line interface. argv defaults to sys.argv[1:]. If stats is a dict, 
+      it receives the number of 'hits' and 'pages' written, and the 'marks' by tag.
+      Returns the exit status: 0 without hits, 1 with hits, as /bin/cmp does.
+  """
+  global metrics_backend
   parser = ArgumentParser(epilog="version: "+__VERSION__, description="highlight words in a PDF file.")
   parser.def_trans = 0.6
   parser.def_decrypt_key = ''
@@ -729,34 +1641,64 @@ def main():
   parser.def_margins = '0,0,0,0'
   parser.def_margins = '0,0,0,0'
   parser.def_below = False
+  parser.def_jobs = cpu_count()
+  parser.def_diff_engine = 'difflib'
+  parser.def_metrics = metrics_backend
+  parser.def_unchanged_pages = 'full'
   parser.add_argument("-c", "--compare-text", metavar="OLDFILE",
                       help="mark added, deleted and replaced text (or see -m) with regard to OLDFILE. \
                             File formats .pdf, .xml, .txt are recognized by their suffix. \
                             The comparison works word by word.")
   parser.add_argument("-d", "--decrypt-key", metavar="DECRYPT_KEY", default=parser.def_decrypt_key,
                       help="open an encrypted PDF; default: KEY='"+parser.def_decrypt_key+"'")
+  parser.add_argument("--diff-engine", metavar="ENGINE", default=parser.def_diff_engine, choices=diff_engines,
+                      help="word diff algorithm used with -c, one of " + ", ".join(diff_engines) + ". \
+                      'difflib' is the reference, it diffs the whole documents at once; 'myers' (shortest \
+                      edit script, linear space), 'histogram' and 'patience' are much faster on large documents, \
+                      they only diff the pages between identical pages, split at unique words. Default: " + parser.def_diff_engine)
   parser.add_argument("-e", "--exclude-irrelevant-pages", default=False, action="store_true",
                       help="with -s: show only matching pages; with -c: show only changed pages; \
                       default: reproduce all pages from INFILE in OUTFILE")
   parser.add_argument("-f", "--features", metavar="FEATURES", default=parser.def_features,
                       help="specify how to mark. Allowed values are 'highlight', 'changebar', 'popup', \
                       'navigation', 'watermark', 'margin'. Default: " + str(parser.def_features))
+  parser.add_argument("--font-cache", metavar="FILE",
+                      help="keep font file names and glyph widths in FILE (JSON) across runs, \
+                      so that repeated runs skip font resolution. Default: no cache file.")
   parser.add_argument("-i", "--nocase", default=False, action="store_true",
                       help="make -s case insensitive; default: case sensitive")
+  parser.add_argument("-j", "--jobs", type=int, default=parser.def_jobs, metavar="N",
+                      help="run up to N pdftohtml processes in parallel. Both documents are extracted \
+                      at the same time, large documents are split into page ranges. Also the page overlays \
+                      and the ranges of a large word diff are processed in parallel. Default: " + str(parser.def_jobs))
   parser.add_argument("-l", "--log",  metavar="LOGFILE", 
                       help="write an python datastructure describing all the overlay objects on each page. Default none.")
   parser.add_argument("-m", "--mark", metavar="OPS", default=parser.def_marks,
                       help="specify what to mark. Used with -c. Allowed values are 'add','delete','change','equal'. \
                             Multiple values can be listed comma-seperated; abbreviations are allowed.\
                             Default: " + str(parser.def_marks))
+  parser.add_argument("--metrics", metavar="BACKEND", default=parser.def_metrics, choices=metrics_backends,
+                      help="where glyph widths for placing the marks come from: 'pygame' fonts; 'ttf' reads \
+                      the hmtx tables of the TrueType fonts found by fc-match; 'afm' uses the widths of the \
+                      standard 14 PDF fonts, needs no font files at all. Default: " + parser.def_metrics)
   parser.add_argument("-n", "--no-output", default=False, action="store_true",
                       help="do not write an output file; print diagnostics only; default: write output file as per -o")
   parser.add_argument("-o", "--output", metavar="OUTFILE", default=parser.def_output,
                       help="write output to FILE; default: "+parser.def_output)
-  parser.add_argument("-s", "--search", metavar="WORD_REGEXP", 
-                      help="highlight WORD_REGEXP")
+  parser.add_argument("-s", "--search", metavar="WORD_REGEXP", action="append",
+                      help="highlight WORD_REGEXP. Can be given multiple times, the popup of a hit then names its pattern.")
+  parser.add_argument("--search-file", metavar="FILE",
+                      help="highlight all terms listed in FILE, one literal term per line (UTF-8). \
+                      Empty lines and lines starting with '#' are skipped. Can be combined with -s. \
+                      Thousands of terms are matched in one pass.")
+  parser.add_argument("--single-canvas", default=False, action="store_true",
+                      help="render the overlays of all pages into one multipage PDF, which is parsed once. \
+                      Saves time per page, but does not use -j. Default: one PDF per page.")
   parser.add_argument("--spell", "--spell-check", default=False, action="store_true",
                       help="run the text body of the (new) pdf through hunspell. Unknown words are underlined. Use e.g. 'env DICTIONARY=en_US ...' (or de_DE, ...) to specify the spelling dictionary, if your system has more than one. To add new words to your private dictionary use e.g. 'echo >> ~/.hunspell_en_US ownCloud'. Check with 'hunspell -D' and study 'man hunspell'.")
+  parser.add_argument("--stream", default=False, action="store_true",
+                      help="parse the pdftohtml output page by page, never holding the full xml tree in memory. \
+                      Recommended for very large documents. Default: build the full tree, which --debug can dump.")
   parser.add_argument("--strict", default=False, action="store_true",
                       help="show really all differences; default: ignore removed hyphenation; ignore character spacing inside a word")
   parser.add_argument("-t", "--transparency", type=float, default=parser.def_trans, metavar="TRANSP", 
@@ -782,17 +1724,60 @@ def main():
                       help="print the version number and exit")
   parser.add_argument("-X", "--no-compression", default=False, action="store_true",
                       help="write uncompressed PDF. Default: FlateEncode filter compression.")
+  parser.add_argument("--batch", metavar="MANIFEST",
+                      help="run all comparisons listed in MANIFEST in this process, or with -j in a pool \
+                      of processes, sharing fonts and caches. MANIFEST is a .json list of objects, or a CSV \
+                      file with a header line, with the keys old, new, output, and options. The other \
+                      command line options apply to all jobs. Exit status: the worst of all jobs.")
+  parser.add_argument("--cache-dir", metavar="DIR",
+                      help="keep the words extracted from the older pdf file in DIR, keyed by its contents, \
+                      page range and margins. Comparing against it again skips pdftohtml for it. Also the \
+                      default for --font-cache. The --spell verdicts are kept there too. Least recently used \
+                      word lists are removed beyond " 
+                      + str(wordlist_cache_max>>20) + "MB. Default: no cache.")
+  parser.add_argument("--chunk-pages", type=int, metavar="N",
+                      help="split documents into page ranges of N pages for parallel extraction; 0: never split. \
+                      Default: spread large documents evenly over all --jobs.")
+  parser.add_argument("--index", default=False, action="store_true",
+                      help="write a search index of INFILE next to it, as INFILE" + search_index_name('') + ". \
+                      It holds the words, text runs and fonts of all pages. Later -s or --search-file runs \
+                      on the same file (without -c, --spell, --strict, -F, -L) use it instead of pdftohtml. \
+                      Without -s, only the index is written. Default: use an existing index, if it is up to date.")
+  parser.add_argument("--incremental", default=False, action="store_true",
+                      help="append the changed pages, annotations and outline as an incremental update \
+                      to a byte copy of INFILE, instead of rewriting it. Overlays become Form XObjects, the \
+                      page contents are not recompressed. Not with -B, -e, -F, -L or encrypted input, \
+                      these fall back to a full rewrite. Default: full rewrite.")
   parser.add_argument("--leftside", default=False, action="store_true",
                       help="put changebars and navigation at the left hand side of the page. Default: right hand side.")
-  parser.add_argument("infile", metavar="INFILE", help="the input file")
+  parser.add_argument("--serve", metavar="ADDRESS",
+                      help="run as a local comparison server on ADDRESS: a path for a unix domain socket, \
+                      or [HOST:]PORT for HTTP, HOST defaults to 127.0.0.1. POST /compare a JSON object with \
+                      old, new, options and optionally output. -j sets the number of worker processes. \
+                      The file names are opened by the server, do not expose it beyond trusted users.")
+  parser.add_argument("--unchanged-pages", metavar="MODE", default=parser.def_unchanged_pages, choices=('full', 'watermark', 'copy'),
+                      help="how to write pages without marks: 'full' like all other pages; 'watermark' with only \
+                      the watermark and margins, rendered once per page size; 'copy' untouched from INFILE. \
+                      Default: " + parser.def_unchanged_pages)
+  parser.add_argument("infile", metavar="INFILE", nargs="?", help="the input file")
   parser.add_argument("infile2", metavar="INFILE2", nargs="?", help="optional 'newer' input file; alternate syntax to -c")
-  args = parser.parse_args()      # --help is automatic
+  if argv is None: argv = sys.argv[1:]
+  args = parser.parse_args(argv)      # --help is automatic
 
   args.transparency = 1 - args.transparency     # it is needed reversed.
 
   if args.version: parser.exit(__VERSION__)
+  if args.batch: return batch_main(parser, args, argv)
+  if args.serve: return serve_main(parser, args, argv)
+  if args.infile is None: parser.error("too few arguments")
   global debug 
   debug = args.debug
+  metrics_backend = args.metrics
+  if metrics_backend == 'pygame':
+    try:
+      pygame_font()
+    except ImportError as e:
+      parser.exit("--metrics pygame: %s, try --metrics afm" % e)
 
   args.search_colors = parser.def_colors.copy()
   if args.search_color:
@@ -821,35 +1806,91 @@ def main():
   if args.compare_text is None and args.infile2 is not None:
     args.compare_text,args.infile = args.infile,args.infile2
 
-  if args.search is None and args.compare_text is None and args.spell is None:
-    parser.exit("Oops. Nothing to do. Specify either -s or --spell or -c or two input files")
+  search_terms = None
+  if args.search_file:
+    try:
+      search_terms = [t.strip() for t in codecs.open(args.search_file, 'r', 'utf8')]
+    except (IOError, UnicodeDecodeError) as e:
+      parser.exit("--search-file %s: %s" % (args.search_file, e))
+    search_terms = [t for t in search_terms if len(t) and t[0] != '#']
+
+  if args.search is None and search_terms is None and args.compare_text is None and args.spell is None and not args.index:
+    parser.exit("Oops. Nothing to do. Specify either -s or --search-file or --spell or -c or --index or two input files")
+  if args.index and (args.first_page or args.last_page):
+    parser.exit("--index: not with -F, -L. The index covers all pages.")
+  matcher = None
+  if args.search or search_terms:
+    try:
+      matcher = SearchMatcher(args.search or [], search_terms or [], args.nocase)
+    except re.error as e:
+      parser.exit("-s: bad regular expression %s" % e)
 
   if not os.access(args.infile, os.R_OK):
     parser.exit("Cannot read input file: %s" % args.infile)
-  dom1 = pdf2xml(parser, args.infile, key=args.decrypt_key, firstpage=args.first_page, lastpage=args.last_page)
-  dom2 = None
+  # extract both documents at the same time, each possibly in multiple chunks.
+  pool = ThreadPool(max(1, args.jobs))
+  # a plain search can use the --index of INFILE, instead of pdftohtml.
+  pure_search = (args.search or search_terms) and not (args.compare_text or args.spell or args.strict 
+                                                        or args.first_page or args.last_page)
+  index = None
+  if pure_search and not args.index:
+    index = search_index_get(args.infile)
+    if index is not None:
+      print("%s: using search index %s" % (args.infile, search_index_name(args.infile)))
+  pdf2xml_job1 = None
+  if index is None:
+    pdf2xml_job1 = pdf2xml_start(args.infile, key=args.decrypt_key, firstpage=args.first_page, lastpage=args.last_page,
+                                 pool=pool, chunk_pages=args.chunk_pages, jobs=args.jobs)
+  pdf2xml_job2 = None
   wordlist2 = None
-  if args.compare_text:
-    if re.search('\.pdf$', args.compare_text, re.I):
-      dom2 = pdf2xml(parser, args.compare_text, key=args.decrypt_key, firstpage=args.first_page, lastpage=args.last_page)
-      first_page = args.first_page
-      if first_page is not None: first_page = int(first_page) - 1
-      last_page = args.last_page
-      if last_page is not None: last_page = int(last_page) - 1
+  wordlist2_key = None
+  if args.compare_text and re.search('\.pdf$', args.compare_text, re.I):
+    first_page = args.first_page
+    if first_page is not None: first_page = int(first_page) - 1
+    last_page = args.last_page
+    if last_page is not None: last_page = int(last_page) - 1
+    if args.cache_dir:
+      wordlist2_key = wordlist_cache_key(args.compare_text, first_page, last_page, margins)
+      wordlist2 = wordlist_cache_get(args.cache_dir, wordlist2_key)
+      if wordlist2 is not None:
+        print("%s: %d words from cache" % (args.compare_text, len(wordlist2)))
+  if wordlist2 is None and args.compare_text and re.search('\.pdf$', args.compare_text, re.I):
+    pdf2xml_job2 = pdf2xml_start(args.compare_text, key=args.decrypt_key, firstpage=args.first_page, lastpage=args.last_page,
+                                 pool=pool, chunk_pages=args.chunk_pages, jobs=args.jobs)
+  if args.stream:
+    # page streams, consumed exactly once, by xml2wordlist() or pdfhtml_xml_find()
+    pdf2xml_dom = pdf2xml_pages
+  else:
+    pdf2xml_dom = pdf2xml_collect
+  dom1 = None
+  if args.index:
+    dom1 = pdf2xml_collect(parser, pdf2xml_job1)
+    index = search_index_put(args.infile, dom1)
+    if not (args.search or search_terms or args.compare_text or args.spell):
+      pool.close()
+      return 0
+    if not pure_search: index = None
+  elif pdf2xml_job1 is not None:
+    dom1 = pdf2xml_dom(parser, pdf2xml_job1)
+  dom2 = None
+  if args.compare_text and wordlist2 is None:
+    if pdf2xml_job2 is not None:
+      dom2 = pdf2xml_dom(parser, pdf2xml_job2)
       wordlist2 = xml2wordlist(dom2, first_page, last_page, margins=margins)
+      if wordlist2_key is not None:
+        wordlist_cache_put(args.cache_dir, wordlist2_key, wordlist2)
     elif re.search('\.xml$', args.compare_text, re.I):
       wordlist2 = xmlfile2wordlist(args.compare_text)
     else:
       # assuming a plain text document
       wordlist2 = textfile2wordlist(args.compare_text)
 
-  if debug:
+  if debug and not args.stream and dom1 is not None:
     dom1.write(args.output + ".1.xml")
     if dom2:
       dom2.write(args.output + ".2.xml")
 
-  PGF.init()
-  # This pygame.font module is used to calculate widths of all glyphs
+  # The font metrics (see --metrics) are used to calculate widths of all glyphs
   # for words we need to mark. With this calculation, we can determine 
   # the exact position and length of the marks, if the marked word is 
   # only a substring (which it often is).
@@ -885,22 +1926,50 @@ def main():
       first_page = last_page
   print("input pages: %d-%d" % (first_page+1, last_page+1))
 
-  page_marks = pdfhtml_xml_find(dom1, re_pattern=args.search, 
-      wordlist=wordlist2,
-      nocase=args.nocase,
-      first_page=first_page,
-      last_page=last_page,
-      mark_ops=args.mark,
-      margins=margins,
-      strict=args.strict,
-      spell_check=args.spell,
-      move_similarity=0.75,     # 0.75 implies 1 of 1, 2 of 2, 3 of 3, 3 of 4 identical.
-      move_minwords=1,
-      ext={'a': {'c':args.search_colors['A']},
-           'd': {'c':args.search_colors['D']},
-           'c': {'c':args.search_colors['C']},
-           'm': {'c':args.search_colors['M']},
-           'e': {'c':args.search_colors['E']} })
+  incremental = None
+  if args.incremental:
+    try:
+      xref_stream = pdf_startxref(args.infile)[1]
+    except Exception as e:
+      print("--incremental: %s" % e)
+      xref_stream = True
+    for why, cond in (('-B', args.below), ('-e', args.exclude_irrelevant_pages),
+                      ('-F, -L', first_page > 0 or last_page < input1.getNumPages()-1),
+                      ('encrypted input', input1.getIsEncrypted()),
+                      ('cross-reference streams', xref_stream)):
+      if cond and incremental is None: incremental = why
+    if incremental is not None:
+      print("--incremental: not with %s, falling back to full rewrite." % incremental)
+    incremental = incremental is None
+
+  if args.cache_dir and not args.font_cache:
+    if not os.path.isdir(args.cache_dir): os.makedirs(args.cache_dir)
+    args.font_cache = os.path.join(args.cache_dir, 'font_metrics.json')
+  if args.font_cache: font_metrics_load(args.font_cache)
+  ext = {'a': {'c':args.search_colors['A']},
+         'd': {'c':args.search_colors['D']},
+         'c': {'c':args.search_colors['C']},
+         'm': {'c':args.search_colors['M']},
+         'e': {'c':args.search_colors['E']} }
+  if index is not None:
+    page_marks = index.search(matcher, ext)
+  else:
+    page_marks = pdfhtml_xml_find(dom1, re_pattern=matcher, 
+        wordlist=wordlist2,
+        nocase=args.nocase,
+        first_page=first_page,
+        last_page=last_page,
+        mark_ops=args.mark,
+        margins=margins,
+        strict=args.strict,
+        spell_check=args.spell,
+        move_similarity=0.75,     # 0.75 implies 1 of 1, 2 of 2, 3 of 3, 3 of 4 identical.
+        move_minwords=1,
+        diff_engine=args.diff_engine,
+        jobs=args.jobs,
+        cache_dir=args.cache_dir,
+        ext=ext)
+  if args.font_cache: font_metrics_save(args.font_cache)
 
   if args.log is not None:
     lf = open(args.log, "w")
@@ -912,11 +1981,13 @@ def main():
   #          : This is the insane way, we duplicate this code from
   #          : PdfFileWriter.__init__()
   # FIXME: We should also copy the XMP metadata from the document.
+  info = None
   try:
     di = input1.getDocumentInfo()
+    if di is None: di = Pdf.DictionaryObject()
 
     # update ModDate, Creator, DiffCmd
-    selfcmd = " ".join(sys.argv) + ' # V' + __VERSION__ + ' ' + time.ctime()
+    selfcmd = " ".join(sys.argv[:1] + argv) + ' # V' + __VERSION__ + ' ' + time.ctime()
     if not "/Creator" in di:
       di[Pdf.NameObject('/Creator')] = Pdf.createStringObject(selfcmd)
     elif not '/Producer' in di:
@@ -927,6 +1998,7 @@ def main():
       print("DocumentInfo():")
       pprint(di)
     output._objects.append(di)
+    info = di           # also for write_incremental()
   except Exception,e:
     print("WARNING: getDocumentInfo() failed: " + str(e) )
 
@@ -934,6 +2006,7 @@ def main():
 
   pages_written = 0
   total_hits = 0
+  total_marks = {}
   outline = []
 
   page_idx = 0
@@ -948,9 +2021,81 @@ def main():
     if not nav_fwd is None: page_marks[i]['nav_fwd'] = nav_fwd
     if len(page_marks[i]['rect']): nav_fwd = page_idx
 
+  pages = []
+  jobs = []
   for i in range(first_page,last_page+1):
     if args.exclude_irrelevant_pages and len(page_marks[i]['rect']) == 0:
       continue
+    page = input1.getPage(i)
+    mbox = page['/MediaBox']     # landscape look like [0, 0, 794, 595]
+    cbox= page.get('/CropBox', page.get('/TrimBox', mbox))
+    # IBM delivers documents with 
+    # '/TrimBox': [0, 0, 612, 792], '/CropBox': [0, 0, 612, 792], '/MediaBox': [0, 0, 842, 842]
+    # where the printable text lives in the MediaBox coordinate system for scaling, 
+    # but all my watermark, changemark, and such must be placed inside the CropBox 
+    job = {'mbox':[float(x) for x in mbox], 'cbox':[float(x) for x in cbox], 
+           'marks':page_marks[i], 'page_idx':i-first_page, 
+           'argv':sys.argv[:1] + argv, 'color':args.search_colors['E'], 'trans':args.transparency,
+           'margins':margins, 'features':args.features, 'leftside':args.leftside, 'debug':debug,
+           'watermark':args.below}      # see shared_watermark() below
+    if args.unchanged_pages != 'full' and len(page_marks[i]['rect']) == 0:
+      # no overlay of its own. See unchanged_overlay() below.
+      pages.append((i, job))
+    else:
+      pages.append((i, None))
+      jobs.append(job)
+
+  # The watermark and the margins are the same on all pages of a geometry.
+  # They are painted once into a Form XObject, which all pages reference.
+  # With -B they must be below the page, and remain in the page overlays.
+  shared_watermarks = {}
+  def shared_watermark(page, job):
+    key = (tuple(job['mbox']), tuple(job['cbox']), job['marks']['w'], job['marks']['h'])
+    if not key in shared_watermarks:
+      name = '/PdfcompareWatermark%d' % len(shared_watermarks)
+      xobj = watermark_xobject(output, job, not args.no_compression)
+      shared_watermarks[key] = (name, xobj) + stamp_streams(output, name)
+    name, xobj, before, after = shared_watermarks[key]
+    if xobj is not None:
+      stamp_xobject(output, page, name, xobj, before, after)
+
+  unchanged_overlays = {}
+  def unchanged_overlay(job):
+    """ returns the overlay page for a page without marks: only watermark and
+        margins, no navigation marks. It is rendered once per page geometry.
+    """
+    key = (tuple(job['mbox']), tuple(job['cbox']), job['marks']['w'], job['marks']['h'])
+    if not key in unchanged_overlays:
+      job = job.copy()
+      job['marks'] = {'rect':[], 'w':job['marks']['w'], 'h':job['marks']['h'], 'nav_c':job['marks']['nav_c']}
+      pdf_bytes = render_overlay(job)
+      unchanged_overlays[key] = [pdf_bytes, PdfFileReader(StringIO(pdf_bytes)).getPage(0)]
+    pdf_bytes, overlay = unchanged_overlays[key]
+    if args.below:
+      # mergePage() modifies the overlay page, each page needs its own.
+      overlay = PdfFileReader(StringIO(pdf_bytes)).getPage(0)
+    return overlay
+
+  # The overlays are independent per page, they are rendered in parallel.
+  # Merging them into the output stays in page order.
+  render_pool = None
+  overlay_pdf = None
+  if args.single_canvas:
+    # all overlays in one PDF, parsed once.
+    overlay_str = StringIO(render_overlays(jobs))
+    if debug:
+      file("canvas.pdf", 'w').write(overlay_str.getvalue())
+    overlay_pdf = PdfFileReader(overlay_str)
+  elif args.jobs > 1 and len(jobs) > 1:
+    render_pool = Pool(args.jobs)
+    overlays = render_pool.imap(render_overlay, jobs, max(1, len(jobs) // (4*args.jobs)))
+  else:
+    overlays = (render_overlay(job) for job in jobs)
+
+  overlays_used = 0
+  overlay_stamp = None
+  overlay_resources = {}        # shared by all overlays, see overlay_xobject()
+  for i, unchanged_job in pages:
     hitdetails = {'equ':0, 'add':0, 'del':0, 'chg':0, 'spl':0, 'mov':0 }
     for r in page_marks[i]['rect']:
       tag = r.get('t','unk')
@@ -958,6 +2103,7 @@ def main():
         hitdetails[tag] = 0
       hitdetails[tag] += 1
       total_hits += 1
+      total_marks[tag] = total_marks.get(tag, 0) + 1
     hits_fmt = ''
     for det,ch in (['add','+'], ['del','-'], ['chg','~'], ['equ','='], ['mov','>'], ['spl','!']):
       if hitdetails[det]: hits_fmt += '%s%d' % (ch,hitdetails[det])
@@ -967,33 +2113,29 @@ def main():
     # pprint(hitdetails)
 
     page = input1.getPage(i)
-    mbox = page['/MediaBox']     # landscape look like [0, 0, 794, 595]
-    cbox= page.get('/CropBox', page.get('/TrimBox', mbox))
-    # IBM delivers documents with 
-    # '/TrimBox': [0, 0, 612, 792], '/CropBox': [0, 0, 612, 792], '/MediaBox': [0, 0, 842, 842]
-    # where the printable text lives in the MediaBox coordinate system for scaling, 
-    # but all my watermark, changemark, and such must be placed inside the CropBox 
-
-    ## create a canvas of correct size, 
-    ## paint semi-transparent highlights on the canvas,
-    ## then save the canvas to memory string as proper PDF,
-    ## merge this string ontop of the original page.
-    pdf_str = StringIO()
-    c = canvas.Canvas(pdf_str, pagesize=(mbox[2],mbox[3]))
-    page_watermark(c, cbox, sys.argv, color=args.search_colors['E'], trans=args.transparency, 
-                   p_w=page_marks[i]['w'], p_h=page_marks[i]['h'], margins=margins, features=args.features)
-    page_changemarks(c, mbox, cbox, page_marks[i], i-first_page, trans=args.transparency, leftside=args.leftside, features=args.features)
-
-    # c.textAnnotation('Here is a Note', Rect=[34,0,0,615], addtopage=1,Author='Test Opacity=0.1',Color=[0.7,0.8,1],Type='/Comment',Opacity=0.1)
-    # c.linkURL(".: Here is a Note", (30,10,200,20), relative=0, Border="[ 1 1 1 ]")
-
-    c.save()
-    pdf_str.seek(0,0)
-    if debug:
-      file("canvas_%d.pdf"%i, 'w').write(pdf_str.getvalue())
-      pdf_str.seek(0,0)
-    input2 = PdfFileReader(pdf_str)
-    highlight_page = input2.getPage(0)
+    if unchanged_job is not None and args.unchanged_pages == 'copy':
+      output.addPage(page)
+      pages_written += 1
+      continue
+    if not args.below:
+      shared_watermark(page, unchanged_job or jobs[overlays_used])
+      if unchanged_job is not None:
+        output.addPage(page)
+        pages_written += 1
+        continue
+    ## merge the overlay of this page ontop of the original page.
+    if unchanged_job is not None:
+      highlight_page = unchanged_overlay(unchanged_job)
+    elif overlay_pdf is not None:
+      highlight_page = overlay_pdf.getPage(overlays_used)
+    else:
+      pdf_str = StringIO(next(overlays))
+      if debug:
+        file("canvas_%d.pdf"%i, 'w').write(pdf_str.getvalue())
+      input2 = PdfFileReader(pdf_str)
+      highlight_page = input2.getPage(0)
+    if unchanged_job is None:
+      overlays_used += 1
     if args.below:
       ## We can paint below or above the document.
       ## Below looks better, as the fonts are true black,
@@ -1004,14 +2146,41 @@ def main():
       if not args.no_compression:
         highlight_page.compressContentStreams()
       output.addPage(highlight_page)
+    elif incremental:
+      # the page contents stay as they are in INFILE, see write_incremental()
+      name = '/PdfcompareOverlay'
+      if overlay_stamp is None:
+        overlay_stamp = stamp_streams(output, name)
+      xobj = overlay_xobject(output, highlight_page, not args.no_compression, overlay_resources)
+      stamp_xobject(output, page, name, xobj, *overlay_stamp)
+      mergeAnnotsRelocate(page, highlight_page, first_page, relocate=overlay_pdf is None)
+      output.addPage(page)
     else:
       page.mergePage(highlight_page)
-      mergeAnnotsRelocate(page, highlight_page, first_page)
+      mergeAnnotsRelocate(page, highlight_page, first_page, relocate=overlay_pdf is None)
       if not args.no_compression:
         page.compressContentStreams()
       output.addPage(page)
 
     pages_written += 1
+  if render_pool is not None:
+    render_pool.close()
+    render_pool.join()
+  if overlay_pdf is not None:
+    # navigation links point to pages of overlay_pdf, 
+    # let them point to the output pages instead.
+    kids = output.getObject(output._pages)['/Kids']
+    page_refs = {}
+    n = 0
+    for p in range(len(pages)):
+      if pages[p][1] is None:
+        page_refs[overlay_pdf.getPage(n).indirectRef.idnum] = kids[p]
+        n += 1
+    for ref in kids:
+      for a in ref.getObject().get('/Annots', []):
+        dest = a.getObject().get('/Dest')
+        if dest is not None and dest[0].pdf is overlay_pdf and dest[0].idnum in page_refs:
+          dest[0] = page_refs[dest[0].idnum]
   print("saving %s" % args.output)
   # add outline  
   parent = output.addBookmark('Hits', 0) # add parent bookmark
@@ -1019,21 +2188,211 @@ def main():
        output.addBookmark(bm,outline.index(bm),parent=parent)
   
   if args.no_output is False:
-    outputStream = file(args.output, "wb")
     try:
-      output.write(outputStream)
+      if incremental:
+        n = write_incremental(args.infile, args.output, input1, output, info)
+        if debug: print("write_incremental: %d objects appended." % n)
+      else:
+        outputStream = file(args.output, "wb")
+        output.write(outputStream)
+        outputStream.close()
     except Exception as e:
       import traceback
       traceback.print_exc()
       print("\n\nYou found a bug. Maybe retry with --below ?")
       sys.exit(1)
-    outputStream.close()
     print("%s (%s pages) written." % (args.output, pages_written))
 
+  pool.close()
+  if stats is not None:
+    stats.update({'hits':total_hits, 'pages':pages_written, 'marks':total_marks})
   if total_hits:
-    sys.exit(1)
+    return 1
+  return 0
+
+
+def batch_manifest(fname):
+  """ reads the jobs of a --batch manifest. A .json file holds a list of objects,
+      other files are CSV with a header line. A job has the keys 'old', 'new', 
+      'output', and optionally 'options': a list of command line options, or a 
+      string that is split like a shell does. Returns a list of dicts.
+  """
+  if fname.lower().endswith('.json'):
+    jobs = json.load(open(fname))
+  else:
+    jobs = list(csv.DictReader(open(fname, 'rb')))
+  for job in jobs:
+    opts = job.get('options') or []
+    if not isinstance(opts, list): opts = shlex.split(opts)
+    job['options'] = [str(o) for o in opts]
+  return jobs
+
+def argv_without(argv, option):
+  """ argv without option and its value, as '--option VALUE' or '--option=VALUE'. """
+  r = []
+  skip = False
+  for a in argv:
+    if skip: skip = False
+    elif a == option: skip = True
+    elif not a.startswith(option + '='): r.append(a)
+  return r
+
+def batch_run(argv, stats=None):
+  """ runs main() with argv for one job of a --batch manifest, in this process.
+      The fonts and metrics loaded by earlier jobs are reused.
+      Returns the exit status, 0: no differences, 1: differences, 2: trouble.
+      On trouble, stats receives the message as 'error'.
+  """
+  try:
+    return main(argv, stats)
+  except SystemExit as e:
+    # parser.exit() on errors, or the write failure.
+    if stats is not None: stats['error'] = str(e.code)
+    return 2
+  except Exception as e:
+    import traceback
+    traceback.print_exc()
+    if stats is not None: stats['error'] = str(e)
+    return 2
+
+def batch_main(parser, args, argv):
+  """ the --batch mode of main(): runs all jobs of the manifest, one after the 
+      other, or in a pool of --jobs processes. The command line options other 
+      than --batch apply to all jobs, the options of a job are added after them.
+      Prints one summary line per job, returns the worst exit status.
+  """
+  base = argv_without(argv, '--batch')
+  try:
+    jobs = batch_manifest(args.batch)
+  except (IOError, ValueError, csv.Error) as e:
+    parser.exit(2, "--batch %s: %s\n" % (args.batch, e))
+  runs = []
+  for job in jobs:
+    if not job.get('new') or not job.get('output'):
+      runs.append(None)
+      continue
+    run = base + job['options'] + ['-o', job['output']]
+    if job.get('old'): run.append(job['old'])
+    runs.append(run + [job['new']])
+  todo = [r for r in runs if r is not None]
+  if args.jobs > 1 and len(todo) > 1:
+    # the jobs run in parallel, each one uses a single process.
+    pool = Pool(args.jobs)
+    results = pool.map(batch_run, [r + ['-j', '1'] for r in todo], 1)
+    pool.close()
+    pool.join()
+  else:
+    results = [batch_run(r) for r in todo]
+  status = 0
+  verdicts = {0:'no differences', 1:'differences', 2:'failed'}
+  for n, job in enumerate(jobs):
+    r = 2
+    if runs[n] is not None: r = results.pop(0)
+    status = max(status, r)
+    print("batch %d/%d: %s %s -> %s: %s" % (n+1, len(jobs), job.get('old') or '-', 
+          job.get('new') or '-', job.get('output') or '-', verdicts[r]))
+  return status
+
+def serve_run(argv):
+  """ runs one request of the --serve mode in a pool worker. Returns (status, stats). """
+  stats = {}
+  status = batch_run(argv, stats)
+  return (status, stats)
+
+def serve_main(parser, args, argv):
+  """ the --serve mode of main(): a local HTTP server, that runs comparisons
+      in a pool of --jobs worker processes. The workers are started once, 
+      their imports, fonts and metrics stay warm from one request to the next.
+      The address is a path for a unix domain socket, or [HOST:]PORT on localhost.
+      POST /compare with a JSON object {"old":..., "new":..., "options":[...]}:
+      the response is the output pdf, with the exit status and the hit count in 
+      X-Pdfcompare-Status and X-Pdfcompare-Hits headers. If the request has an 
+      "output" file name, the pdf is written there, and the response is a JSON 
+      object with status, hits, pages, marks, output.
+      A failed comparison (status 2, or no pdf written) is answered with 500 
+      and a JSON object with status and error.
+      The command line options other than --serve apply to all requests.
+      Runs until interrupted, and returns 0.
+  """
+  import BaseHTTPServer, SocketServer
+  base = argv_without(argv, '--serve')
+  pool = Pool(max(1, args.jobs))
+
+  class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, format, *a):
+      # a unix domain socket has no client address.
+      client = self.client_address[0] if self.client_address else args.serve
+      sys.stderr.write("%s - - [%s] %s\n" % (client, self.log_date_time_string(), format % a))
+
+    def reply(self, code, body, ctype='application/json', headers={}):
+      self.send_response(code)
+      self.send_header('Content-Type', ctype)
+      self.send_header('Content-Length', str(len(body)))
+      for k, v in headers.items(): self.send_header(k, v)
+      self.end_headers()
+      self.wfile.write(body)
+
+    def do_GET(self):
+      self.reply(200, json.dumps({'version':__VERSION__, 'jobs':max(1, args.jobs)}))
+
+    def do_POST(self):
+      if self.path != '/compare':
+        return self.reply(404, json.dumps({'error':'POST /compare'}))
+      try:
+        req = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        if not req.get('new'): raise ValueError("'new' is missing")
+        opts = req.get('options') or []
+        if not isinstance(opts, list): opts = shlex.split(opts)
+      except ValueError as e:
+        return self.reply(400, json.dumps({'error':str(e)}))
+      output = req.get('output')
+      if output is None:
+        (fd, output) = tempfile.mkstemp(prefix='pdfcompare_', suffix='.pdf')
+        os.close(fd)
+      run = base + [str(o) for o in opts] + ['-j', '1', '-o', output]
+      if req.get('old'): run.append(req['old'])
+      (status, stats) = pool.apply(serve_run, (run + [req['new']],))
+      if status != 2 and not (os.path.exists(output) and os.path.getsize(output)):
+        (status, stats['error']) = (2, "no output written")
+      if req.get('output') is None:
+        try:
+          pdf = open(output, 'rb').read()
+        except IOError:
+          pdf = ''
+        if os.path.exists(output): os.unlink(output)
+      if status == 2:
+        return self.reply(500, json.dumps({'status':status, 'error':stats.get('error', 'failed')}))
+      if req.get('output') is not None:
+        stats.update({'status':status, 'output':output})
+        return self.reply(200, json.dumps(stats))
+      self.reply(200, pdf, 'application/pdf', {'X-Pdfcompare-Status':str(status),
+                                                'X-Pdfcompare-Hits':str(stats.get('hits', 0))})
+
+  # PORT or HOST:PORT, everything else is the path of a unix domain socket.
+  port = re.match(r'^(?:(.*):)?(\d+)$', args.serve)
+  if port is None:
+    class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer): 
+      daemon_threads = True
+    if os.path.exists(args.serve):
+      if not stat.S_ISSOCK(os.stat(args.serve).st_mode):
+        pool.terminate()
+        parser.exit("--serve %s: exists, and is not a socket." % args.serve)
+      os.unlink(args.serve)
+    server = Server(args.serve, Handler)
   else:
-    sys.exit(0)
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer): 
+      daemon_threads = True
+    server = Server((port.group(1) or '127.0.0.1', int(port.group(2))), Handler)
+  print("serving on %s, %d workers" % (args.serve, max(1, args.jobs)))
+  sys.stdout.flush()
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  server.server_close()
+  pool.terminate()
+  if port is None: os.unlink(args.serve)
+  return 0
 
 
 def parse_margins(text,color):
@@ -1043,12 +2402,145 @@ def parse_margins(text,color):
           'w':float(a[2]), 's':float(a[3]), 'c':color}
 
 
+class TTFMetrics():
+  """Glyph advances of a TrueType font, as read from its hmtx and cmap 
+     tables by reportlab. metrics() is compatible with pygame.font.Font().
+  """
+  def __init__(self, f_file, size):
+    ttf = TTFontFile(f_file, validate=0)
+    scale = size/1000.0
+    self.default = ttf.defaultWidth*scale
+    self.widths = array('d', [self.default]) * (min(max(ttf.charWidths or [0]), 0xffff)+1)
+    self.wide = {}
+    for cp, w in ttf.charWidths.items():
+      if cp < len(self.widths): self.widths[cp] = w*scale
+      else:                     self.wide[cp] = w*scale
+
+  def metrics(self, str):
+    r = []
+    for c in str:
+      cp = ord(c)
+      if cp < len(self.widths): w = self.widths[cp]
+      else:                     w = self.wide.get(cp, self.default)
+      r.append((0, 0, 0, 0, w))
+    return r
+
+def afm_font_name(family):
+  """ maps a family name as seen in pdftohtml fontspec elements, e.g. 
+      'ABCDEF+Arial-BoldMT' to one of the standard 14 PDF fonts.
+  """
+  f = re.sub('^[A-Z]{6}\+', '', family).lower()
+  if 'courier' in f or 'mono' in f: 
+    name = 'Courier'
+  elif 'times' in f or 'roman' in f or ('serif' in f and not 'sans' in f): 
+    name = 'Times'
+  else: 
+    name = 'Helvetica'
+  bold = 'bold' in f or 'black' in f or 'heavy' in f
+  italic = 'italic' in f or 'oblique' in f
+  if name == 'Times':
+    if bold and italic: return 'Times-BoldItalic'
+    if bold:            return 'Times-Bold'
+    if italic:          return 'Times-Italic'
+    return 'Times-Roman'
+  if bold and italic: return name + '-BoldOblique'
+  if bold:            return name + '-Bold'
+  if italic:          return name + '-Oblique'
+  return name
+
+class AFMMetrics():
+  """Glyph advances of one of the standard 14 PDF fonts, from the AFM 
+     widths built into reportlab. metrics() is compatible with pygame.font.Font().
+  """
+  def __init__(self, family, size):
+    font = pdfmetrics.getFont(afm_font_name(family))
+    scale = size/1000.0
+    # indexed by WinAnsiEncoding codes.
+    self.widths = array('d', [w*scale for w in font.widths])
+    self.default = 500*scale
+
+  def metrics(self, str):
+    r = []
+    for c in str:
+      try:
+        w = self.widths[ord(c.encode('cp1252'))]
+      except UnicodeError:
+        w = self.default
+      r.append((0, 0, 0, 0, w))
+    return r
+
+def open_font(family, f_file, size):
+  """ returns a font object with a metrics() method, as selected by --metrics.
+      With 'ttf', fonts that are not TrueType fall back to 'afm'.
+  """
+  if metrics_backend == 'pygame':
+    return pygame_font().Font(f_file, size)
+  if metrics_backend == 'ttf' and f_file is not None:
+    try:
+      return TTFMetrics(f_file, size)
+    except (TTFError, IOError) as e:
+      if debug: print("%s: %s, using afm metrics" % (f_file, e))
+  return AFMMetrics(family, size)
+
+class FontAdvances():
+  """Wraps a font with a metrics() method, e.g. a pygame.font.Font().
+     The advance width of each codepoint is asked from the font only once.
+     For the text runs seen recently, prefix sums of the advances are kept,
+     so that rendered_text_pos() finds any substring in O(1), 
+     no matter how many words of a text run are marked.
+  """
+  max_runs = 1000
+
+  def __init__(self, font=None, family=None, file=None, size=None):
+    # without a font, open_font() is called when first needed.
+    self.font = font
+    self.family = family
+    self.file = file
+    self.size = size
+    self.adv = {}
+    self.runs = {}
+
+  def _font(self):
+    if self.font is None:
+      self.font = open_font(self.family, self.file, self.size)
+    return self.font
+
+  def advance(self, c):
+    a = self.adv.get(c)
+    if a is None:
+      m = self._font().metrics(c)
+      # metrics() has None for a glyph that is not in the font.
+      if m and m[0]: a = m[0][4]
+      else:          a = 0
+      self.adv[c] = a
+    return a
+
+  def metrics(self, str):
+    return self._font().metrics(str)
+
+  def width(self, str):
+    return sum([self.advance(c) for c in str])
+
+  def prefix_sums(self, text):
+    """ returns a list p with p[i] being the width of text[:i] """
+    p = self.runs.get(text)
+    if p is None:
+      w = 0
+      p = [0]
+      for c in text:
+        w += self.advance(c)
+        p.append(w)
+      if len(self.runs) >= self.max_runs: self.runs.clear()
+      self.runs[text] = p
+    return p
+
 def rendered_text_width(str, font=None):
   """Returns the width of str, in font units.
      If font is not specified, then len(str) is returned.
      """
   if (font is None): return len(str)
   if (len(str) == 0): return 0
+  if isinstance(font, FontAdvances): return font.width(str)
   # return sum(map(lambda x: x[4], font.metrics(str)))
   return sum([x[4] for x in font.metrics(str)])
 
@@ -1063,6 +2555,19 @@ def rendered_text_pos(string1, char_start, char_count, font=None, xoff=0, width=
      If width is specified, it is used to recalculate positions so that the entire string1 fits in width.
      Otherwise the values calculated by summing up font metrics by character are used directly.
      """
+  if isinstance(font, FontAdvances):
+    p = font.prefix_sums(string1)
+    start = min(char_start, len(string1))
+    end = min(char_start+char_count, len(string1))
+    pre_w = p[start]
+    str_w = p[end]-p[start]
+    ratio = 1
+    if (width is not None): 
+      tot_w = p[-1]
+      if (tot_w == 0): tot_w = 1
+      ratio = float(width)/tot_w
+    return (xoff+pre_w*ratio, str_w*ratio)
+
   pre = string1[:char_start]
   str = string1[char_start:char_start+char_count]
   suf = string1[char_start+char_count:]
@@ -1080,14 +2585,15 @@ def rendered_text_pos(string1, char_start, char_count, font=None, xoff=0, width=
   return (xoff+pre_w*ratio, str_w*ratio)
 
 def create_mark(text,offset,length, font, t_x, t_y, t_w, t_h, ext={}):
+  # t_x, t_y, t_w, t_h are floats, as stored in a WordTable.
   #print("word: at %d is '%s'" % (offset, text[offset:offset+length]),)
     
   (xoff,width) = rendered_text_pos(text, offset, length,
-                          font, float(t_x), float(t_w))
+                          font, t_x, t_w)
   #print("  xoff=%.1f, width=%.1f" % (xoff, width))
 
-  mark = {'x':xoff, 'y':float(t_y)+float(t_h),
-          'w':width, 'h':float(t_h), 't':text[offset:offset+length]}
+  mark = {'x':xoff, 'y':t_y+t_h,
+          'w':width, 'h':t_h, 't':text[offset:offset+length]}
   for k in ext:
     mark[k] = ext[k]
   return mark
@@ -1115,30 +2621,822 @@ def zap_letter_spacing(text):
   #print("zap_letter_spacing('%s') -> '%s'" % (text,t))
   return t
 
+class SearchMatcher():
+  """Finds many search terms in one pass over a text, compiled once.
+     Terms without regexp special characters go into an Aho-Corasick 
+     automaton, all others into compiled alternations of named groups. 
+     Regexps with backreferences, inline flags or named groups of their own
+     would change their meaning in an alternation, they are compiled alone.
+     finditer() returns the hits, not overlapping, as (start, end, term_id) 
+     tuples. term_id is the index into self.terms. Where hits of different 
+     literals or separate regexps overlap, the leftmost longest one is taken. 
+     Within one alternation, re is leftmost first: at a position, the first 
+     regexp that matches wins, in the order given, even if a later one 
+     would match more.
+     A bad regexp raises re.error.
+  """
+  regexp_chars = re.compile(r'[.^$*+?{}\[\]\\|()]')
+  regexp_alone = re.compile(r'\\[1-9]|\(\?P[=<]|\(\?[iLmsux]+\)')
+  max_groups = 99       # python's re has a limit of 100 groups per pattern.
+
+  def __init__(self, patterns=[], literals=[], nocase=False):
+    self.terms = []
+    self.nocase = nocase
+    flags = re.UNICODE
+    if nocase: flags |= re.IGNORECASE
+    regexps = []        # (alternative, number of groups)
+    self.regexps = []   # (compiled regexp, term_id, or None for an alternation)
+    self.goto = [{}]    # Aho-Corasick trie: state -> {char: state}
+    self.out = [None]   # state -> (length, term_id) of a term ending there
+    for p, is_literal in [(p, False) for p in patterns] + [(t, True) for t in literals]:
+      if isinstance(p, str): p = p.decode('utf8', 'replace')
+      if not len(p): continue
+      if is_literal or not self.regexp_chars.search(p):
+        self._add_literal(p, len(self.terms))
+      else:
+        try:
+          groups = re.compile(p, flags).groups
+        except re.error as e:
+          raise re.error("'%s': %s" % (p, e))
+        if self.regexp_alone.search(p):
+          self.regexps.append((re.compile(p, flags), len(self.terms)))
+        else:
+          regexps.append(('(?P<t%d>%s)' % (len(self.terms), p), groups + 1))
+      self.terms.append(p)
+    self._build_links()
+
+    # as many alternatives per compiled pattern, as their groups allow.
+    chunk = []
+    groups = 0
+    for r, n in regexps:
+      if groups + n > self.max_groups and len(chunk):
+        self.regexps.append((re.compile('|'.join(chunk), flags), None))
+        chunk = []
+        groups = 0
+      chunk.append(r)
+      groups += n
+    if len(chunk): self.regexps.append((re.compile('|'.join(chunk), flags), None))
+
+  def _add_literal(self, term, term_id):
+    if self.nocase: term = term.lower()
+    s = 0
+    for c in term:
+      if not c in self.goto[s]:
+        self.goto[s][c] = len(self.goto)
+        self.goto.append({})
+        self.out.append(None)
+      s = self.goto[s][c]
+    if self.out[s] is None: self.out[s] = (len(term), term_id)
+
+  def _build_links(self):
+    # breadth first: fail links, and out_link to the next state with a term ending there.
+    self.fail = [0] * len(self.goto)
+    self.out_link = [0] * len(self.goto)
+    queue = list(self.goto[0].values())
+    for s in queue:
+      for c, t in self.goto[s].items():
+        f = self.fail[s]
+        while f and not c in self.goto[f]: f = self.fail[f]
+        f = self.goto[f].get(c, 0)
+        self.fail[t] = f
+        self.out_link[t] = f if self.out[f] is not None else self.out_link[f]
+        queue.append(t)
+
+  def finditer(self, text, overlapping=False):
+    """ returns the hits in text, see above. With overlapping=True all hits 
+        are returned, also overlapping ones, in no particular order.
+    """
+    hits = []
+    if len(self.goto) > 1:
+      goto, fail, out, out_link = self.goto, self.fail, self.out, self.out_link
+      s = 0
+      for i, c in enumerate(text.lower() if self.nocase else text):
+        while s and not c in goto[s]: s = fail[s]
+        s = goto[s].get(c, 0)
+        t = s if out[s] is not None else out_link[s]
+        while t:
+          hits.append((i+1-out[t][0], i+1, out[t][1]))
+          t = out_link[t]
+    for r, term_id in self.regexps:
+      for m in r.finditer(text):
+        if m.end() > m.start():
+          hits.append((m.start(), m.end(), int(m.lastgroup[1:]) if term_id is None else term_id))
+    if overlapping or (len(self.goto) == 1 and len(self.regexps) <= 1):
+      return hits       # a single alternation does not overlap itself.
+    hits.sort(key=lambda h: (h[0], -h[1], h[2]))
+    r = []
+    end = 0
+    for h in hits:
+      if h[0] >= end:
+        r.append(h)
+        end = h[1]
+    return r
+
+def search_marks(matcher, text, font, x, y, w, h, ext):
+  """ returns the marks of all hits of the SearchMatcher in one text run. """
+  marks = []
+  for start, end, term in matcher.finditer(text):
+    mark = create_mark(text, start, end-start, font, x, y, w, h, ext)
+    mark['term'] = term
+    if len(matcher.terms) > 1: mark['o'] = matcher.terms[term]
+    marks.append(mark)
+  return marks
+
+class SearchIndex():
+  """A persistent search index of one pdf file, see --index.
+     It holds the text runs of all pages with their coordinates and fonts 
+     in a WordTable, the page geometry and fontspecs, and an inverted index 
+     from each word (token id) to its word indices in the WordTable. Through 
+     the columns of the WordTable, a word index gives page, text run and offset.
+     The text runs are stored after zap_letter_spacing(), as -s without --strict 
+     sees them. search() then needs neither pdftohtml nor a dom tree.
+  """
+  def __init__(self, key=None):
+    self.key = key
+    self.wl = WordTable()
+    self.run_page = array('i')  # per text run: physical page number
+    self.pages = []             # per page: geometry and the fontspecs it defines
+    self.postings = None        # token id -> array of word indices, see finish()
+
+  def add_page(self, p):
+    """ adds a page element of a dom tree as generated by pdftohtml -xml. """
+    p_nr = len(self.pages) + 1
+    p_h = float(p.attrib['height'])
+    fspecs = [(int(f.attrib.get('id')), f.attrib.get('family', 'Helvetica'), f.attrib.get('size', 12))
+              for f in p.findall('fontspec')]
+    self.pages.append({'nr':int(p.attrib['number']), 'fonts':fspecs,
+                       'h':p_h, 'w':float(p.attrib['width']),
+                       'x':float(p.attrib['left']), 'y':float(p.attrib['top'])})
+    for e in p.findall('text'):
+      y = float(e.attrib['top'])
+      if   y > 0.66*p_h: l = 'b'
+      elif y > 0.33*p_h: l = 'c'
+      else:              l = 't'
+      self.wl.add_textline(zap_letter_spacing(''.join(e.itertext())), p_nr, l,
+                           float(e.attrib['left']), y, float(e.attrib['width']), 
+                           float(e.attrib['height']), int(e.attrib['font']))
+      self.run_page.append(p_nr)
+
+  def finish(self):
+    """ builds the inverted index, after all pages are added. """
+    postings = {}
+    for i, tok in enumerate(self.wl.tok):
+      if not tok in postings: postings[tok] = array('i')
+      postings[tok].append(i)
+    self.postings = postings
+
+  def tostring(self):
+    return zlib.compress(marshal.dumps({'version':search_index_version, 'key':self.key,
+      'byteorder':sys.byteorder, 'wl':self.wl.tostring(), 'run_page':self.run_page.tostring(), 
+      'pages':self.pages, 'postings':dict([(t, a.tostring()) for t, a in self.postings.items()])}), 1)
+
+  @classmethod
+  def fromstring(cls, data):
+    d = marshal.loads(zlib.decompress(data))
+    if d['version'] != search_index_version: raise ValueError("version %s" % d['version'])
+    if d['byteorder'] != sys.byteorder: raise ValueError("byteorder " + d['byteorder'])
+    idx = cls(d['key'])
+    idx.wl = WordTable.fromstring(d['wl'])
+    idx.run_page.fromstring(d['run_page'])
+    idx.pages = d['pages']
+    idx.postings = {}
+    for t, s in d['postings'].items():
+      idx.postings[t] = array('i')
+      idx.postings[t].fromstring(s)
+    return idx
+
+  def candidate_runs(self, matcher):
+    """ returns the sorted text run ids that may contain a hit of matcher, or 
+        None if all runs need to be searched. Regexps need all runs. A literal 
+        term can only be in runs with a word that contains the longest word 
+        of the term. One pass of an automaton of these longest words over 
+        the vocabulary finds all such words, the postings give their runs.
+    """
+    if len(matcher.regexps): return None
+    longest = []
+    for term in matcher.terms:
+      words = term.split()
+      if not len(words): return None
+      longest.append(max(words, key=len))
+    strings = self.wl.interner.strings
+    starts = array('i')
+    pos = 0
+    for w in strings:
+      starts.append(pos)
+      pos += len(w) + 1
+    vocab = u'\n'.join(strings)      # the longest words contain no whitespace.
+    toks = set()
+    for start, end, t in SearchMatcher([], longest, matcher.nocase).finditer(vocab, overlapping=True):
+      toks.add(bisect.bisect_right(starts, start) - 1)
+    runs = set()
+    for tok in toks:
+      runs.update([self.wl.run[i] for i in self.postings.get(tok, [])])
+    return sorted(runs)
+
+  def search(self, matcher, ext):
+    """ returns the page list of pdfhtml_xml_find() for the SearchMatcher. """
+    wl = self.wl
+    runs = self.candidate_runs(matcher)
+    if runs is None: runs = range(len(wl.text))
+    by_page = {}
+    for r in runs:
+      by_page.setdefault(self.run_page[r], []).append(r)
+    pages_a = []
+    p_finfo = {}
+    for p_nr, pg in enumerate(self.pages, 1):
+      p_finfo = page_fontinfo(p_finfo, pg['fonts'])
+      p_rect = []
+      for r in by_page.get(p_nr, []):
+        p_rect += search_marks(matcher, wl.text[r], p_finfo[wl.font[r]]['font'],
+                               wl.x[r], wl.y[r], wl.w[r], wl.h[r], ext['e'])
+      pages_a.append({'nr':pg['nr'], 'rect':p_rect, 'nav_c':ext['e'].get('c',[.5,.5,.5]),
+                      'h':pg['h'], 'w':pg['w'], 'x':pg['x'], 'y':pg['y']})
+    return pages_a
+
+def search_index_name(fname):
+  return fname + '.pdfidx'
+
+def search_index_get(fname):
+  """ returns the SearchIndex of the pdf file fname, or None if there is none,
+      or if it was made from a different version of the file.
+  """
+  iname = search_index_name(fname)
+  if not os.path.exists(iname): return None
+  try:
+    with open(iname, 'rb') as f:
+      idx = SearchIndex.fromstring(f.read())
+  except (IOError, ValueError, EOFError, KeyError, zlib.error) as e:
+    print("search index %s ignored: %s" % (iname, e))
+    return None
+  if idx.key != wordlist_cache_key(fname):
+    print("search index %s ignored: %s has changed." % (iname, fname))
+    return None
+  return idx
+
+def search_index_put(fname, dom):
+  """ builds the SearchIndex of the pdf file fname from its dom tree (or page 
+      stream), and writes it next to fname. Returns the index.
+  """
+  idx = SearchIndex(wordlist_cache_key(fname))
+  for p in dom_pages(dom):
+    idx.add_page(p)
+  idx.finish()
+  iname = search_index_name(fname)
+  try:
+    with open(iname + '.tmp', 'wb') as f:
+      f.write(idx.tostring())
+    os.rename(iname + '.tmp', iname)
+    print("%s: %d words on %d pages indexed." % (iname, len(idx.wl), len(idx.pages)))
+  except (IOError, OSError) as e:
+    print("search index %s not written: %s" % (iname, e))
+  return idx
+
 def spell_check_word(w):
   if w.lower() in ('files', 'nuernberg', 'ca.'):
     return "dummy implementation. marks the words 'files', 'Nuernberg' and 'ca.'"
   return None
 
-def pdfhtml_xml_find(dom, re_pattern=None, wordlist=None, nocase=False, ext={}, first_page=None, last_page=None, mark_ops="D,A,C", margins=None, strict=False, spell_check=False, move_similarity=0.95, move_minwords=10):
+diff_engines = ('difflib', 'myers', 'histogram', 'patience')
+
+def diff_common_ends(a, b, alo, ahi, blo, bhi, blocks):
+  """ strips the common prefix and suffix of a[alo:ahi] and b[blo:bhi],
+      adding them to blocks. Returns the remaining (alo, ahi, blo, bhi).
+  """
+  k = 0
+  while alo+k < ahi and blo+k < bhi and a[alo+k] == b[blo+k]: k += 1
+  if k: blocks.append((alo, blo, k))
+  alo += k
+  blo += k
+  k = 0
+  while alo < ahi-k and blo < bhi-k and a[ahi-k-1] == b[bhi-k-1]: k += 1
+  if k: blocks.append((ahi-k, bhi-k, k))
+  return (alo, ahi-k, blo, bhi-k)
+
+def diff_myers_split(a, b, alo, ahi, blo, bhi):
+  """ finds the middle snake of Myers' O(ND) algorithm, running the 
+      forward and the reverse search at the same time until they overlap.
+      Only two vectors of size N+M are needed, this is the linear space 
+      variant. Returns the split point (x, y) or None if a[alo:ahi] and
+      b[blo:bhi] have nothing in common.
+  """
+  n = ahi - alo
+  m = bhi - blo
+  max_d = (n + m + 1) // 2
+  v_offset = max_d
+  v_length = 2 * max_d + 2
+  v1 = [-1] * v_length
+  v2 = [-1] * v_length
+  v1[v_offset + 1] = 0
+  v2[v_offset + 1] = 0
+  delta = n - m
+  front = (delta % 2 != 0)      # collisions are checked in the forward pass
+  k1start = k1end = k2start = k2end = 0
+  for d in range(max_d):
+    # forward path
+    for k1 in range(-d + k1start, d + 1 - k1end, 2):
+      k1_offset = v_offset + k1
+      if k1 == -d or (k1 != d and v1[k1_offset - 1] < v1[k1_offset + 1]):
+        x1 = v1[k1_offset + 1]
+      else:
+        x1 = v1[k1_offset - 1] + 1
+      y1 = x1 - k1
+      while x1 < n and y1 < m and a[alo + x1] == b[blo + y1]:
+        x1 += 1
+        y1 += 1
+      v1[k1_offset] = x1
+      if x1 > n:
+        k1end += 2      # ran off the right of the graph
+      elif y1 > m:
+        k1start += 2    # ran off the bottom of the graph
+      elif front:
+        k2_offset = v_offset + delta - k1
+        if k2_offset >= 0 and k2_offset < v_length and v2[k2_offset] != -1:
+          if x1 >= n - v2[k2_offset]:
+            return (alo + x1, blo + y1)
+    # reverse path
+    for k2 in range(-d + k2start, d + 1 - k2end, 2):
+      k2_offset = v_offset + k2
+      if k2 == -d or (k2 != d and v2[k2_offset - 1] < v2[k2_offset + 1]):
+        x2 = v2[k2_offset + 1]
+      else:
+        x2 = v2[k2_offset - 1] + 1
+      y2 = x2 - k2
+      while x2 < n and y2 < m and a[ahi - x2 - 1] == b[bhi - y2 - 1]:
+        x2 += 1
+        y2 += 1
+      v2[k2_offset] = x2
+      if x2 > n:
+        k2end += 2
+      elif y2 > m:
+        k2start += 2
+      elif not front:
+        k1_offset = v_offset + delta - k2
+        if k1_offset >= 0 and k1_offset < v_length and v1[k1_offset] != -1:
+          x1 = v1[k1_offset]
+          y1 = v_offset + x1 - k1_offset
+          if x1 >= n - x2:
+            return (alo + x1, blo + y1)
+  return None
+
+def diff_myers(a, b, alo, ahi, blo, bhi, blocks):
+  """ Myers' linear space diff of a[alo:ahi] and b[blo:bhi]. 
+      Appends (i, j, n) matching blocks to blocks, in no particular order.
+      Recursion is done with an explicit stack, so that long documents 
+      cannot exceed the python recursion limit.
+  """
+  stack = [(alo, ahi, blo, bhi)]
+  while len(stack):
+    (alo, ahi, blo, bhi) = stack.pop()
+    (alo, ahi, blo, bhi) = diff_common_ends(a, b, alo, ahi, blo, bhi, blocks)
+    if alo == ahi or blo == bhi:
+      continue
+    split = diff_myers_split(a, b, alo, ahi, blo, bhi)
+    if split is not None:
+      (x, y) = split
+      stack.append((x, ahi, y, bhi))
+      stack.append((alo, x, blo, y))
+
+def diff_histogram(a, b, alo, ahi, blo, bhi, blocks, max_chain=64):
+  """ histogram diff, similar to git's: split a[alo:ahi] and b[blo:bhi] at 
+      the longest common region around the elements that are least frequent.
+      Only elements that occur equally often in a and b are used, and their 
+      n-th occurrence in a is paired with their n-th occurrence in b. This 
+      keeps repeated page headers and footers from being matched across pages.
+      Elements that occur more than max_chain times are never used as 
+      split points; if nothing else is left, diff_myers() takes over.
+  """
+  stack = [(alo, ahi, blo, bhi)]
+  while len(stack):
+    (alo, ahi, blo, bhi) = stack.pop()
+    (alo, ahi, blo, bhi) = diff_common_ends(a, b, alo, ahi, blo, bhi, blocks)
+    if alo == ahi or blo == bhi:
+      continue
+    occ = {}
+    for i in range(alo, ahi):
+      occ.setdefault(a[i], []).append(i)
+    bocc = {}
+    nth = []            # nth[j-blo]: this is the nth occurrence of b[j]
+    for j in range(blo, bhi):
+      chain = bocc.setdefault(b[j], [])
+      nth.append(len(chain))
+      chain.append(j)
+    best = None         # (count, -length, i, j)
+    j = blo
+    while j < bhi:
+      chain = occ.get(b[j])
+      if chain is None or len(chain) > max_chain or len(chain) != len(bocc[b[j]]):
+        j += 1
+        continue
+      i = chain[nth[j-blo]]
+      # the region count is the lowest count of all its elements.
+      rc = len(chain)
+      s = 0
+      while i-s > alo and j-s > blo and a[i-s-1] == b[j-s-1]:
+        s += 1
+        rc = min(rc, len(occ[a[i-s]]))
+      e = 1
+      while i+e < ahi and j+e < bhi and a[i+e] == b[j+e]:
+        rc = min(rc, len(occ[a[i+e]]))
+        e += 1
+      cand = (rc, -(s+e), i-s, j-s)
+      if best is None or cand < best:
+        best = cand
+      j += e
+    if best is None:
+      diff_myers(a, b, alo, ahi, blo, bhi, blocks)
+      continue
+    (count, k, i, j) = best
+    k = -k
+    blocks.append((i, j, k))
+    stack.append((i+k, ahi, j+k, bhi))
+    stack.append((alo, i, blo, j))
+
+def patience_anchors(a, b, alo, ahi, blo, bhi):
+  """ returns the (i, j) pairs of elements that are unique in both a[alo:ahi] 
+      and b[blo:bhi], as far as they appear in the same order in both 
+      (the longest increasing subsequence of j, sorted by i).
+  """
+  uniq = {}
+  for i in range(alo, ahi):
+    if a[i] in uniq: uniq[a[i]] = None
+    else:            uniq[a[i]] = i
+  pairs = {}
+  for j in range(blo, bhi):
+    i = uniq.get(b[j])
+    if i is not None:
+      if i in pairs: pairs[i] = None
+      else:          pairs[i] = j
+  pairs = sorted([(i, j) for (i, j) in pairs.items() if j is not None])
+  if not len(pairs):
+    return []
+  # patience sorting: longest increasing subsequence of the j values.
+  tops = []           # j value of the top card of each pile
+  piles = []          # index into pairs of the top card of each pile
+  back = [None] * len(pairs)
+  for n, (i, j) in enumerate(pairs):
+    p = bisect.bisect_left(tops, j)
+    if p > 0: back[n] = piles[p-1]
+    if p == len(tops):
+      tops.append(j)
+      piles.append(n)
+    else:
+      tops[p] = j
+      piles[p] = n
+  anchors = []
+  n = piles[-1]
+  while n is not None:
+    anchors.append(pairs[n])
+    n = back[n]
+  anchors.reverse()
+  return anchors
+
+def diff_split(a, b, alo, ahi, blo, bhi, blocks):
+  """ the pre-pass of a diff: strips the common prefix and suffix of 
+      a[alo:ahi] and b[blo:bhi], and splits the rest at the patience_anchors().
+      The stripped and anchored elements are added to blocks. Returns the 
+      list of (alo, ahi, blo, bhi) ranges in between, which are independent 
+      of each other. Ranges where one side is empty need no diff and are omitted.
+  """
+  (alo, ahi, blo, bhi) = diff_common_ends(a, b, alo, ahi, blo, bhi, blocks)
+  ranges = []
+  anchors = []
+  for (i, j) in patience_anchors(a, b, alo, ahi, blo, bhi):
+    # a single unique word is weak evidence, in a small vocabulary.
+    if ((i > alo and j > blo and a[i-1] == b[j-1]) or 
+        (i+1 < ahi and j+1 < bhi and a[i+1] == b[j+1])):
+      anchors.append((i, j))
+  for (i, j) in anchors + [(ahi, bhi)]:
+    if i < ahi: blocks.append((i, j, 1))
+    if alo < i and blo < j: ranges.append((alo, i, blo, j))
+    (alo, blo) = (i+1, j+1)
+  return ranges
+
+def diff_range(job):
+  """ the matching blocks of the diff engine for a job (a, b, engine), 
+      relative to a and b. The worker function of PageAnchoredMatcher.
+  """
+  (a, b, engine) = job
+  return sequence_matcher(a, b, engine).get_matching_blocks()
+
+def diff_patience(a, b, alo, ahi, blo, bhi, blocks):
+  """ patience diff: elements that are unique in both a[alo:ahi] and 
+      b[blo:bhi] are matched, if they appear in the same order (longest 
+      increasing subsequence). These anchors split the problem. Ranges 
+      without unique common elements are handed to diff_myers().
+  """
+  stack = [(alo, ahi, blo, bhi)]
+  while len(stack):
+    (alo, ahi, blo, bhi) = stack.pop()
+    (alo, ahi, blo, bhi) = diff_common_ends(a, b, alo, ahi, blo, bhi, blocks)
+    if alo == ahi or blo == bhi:
+      continue
+    anchors = patience_anchors(a, b, alo, ahi, blo, bhi)
+    if not len(anchors):
+      diff_myers(a, b, alo, ahi, blo, bhi, blocks)
+      continue
+    ranges = []
+    for (i, j) in anchors:
+      blocks.append((i, j, 1))
+      ranges.append((alo, i, blo, j))
+      (alo, blo) = (i+1, j+1)
+    ranges.append((alo, ahi, blo, bhi))
+    ranges.reverse()
+    stack.extend(ranges)
+
+def diff_collapse_blocks(blocks, len_a, len_b):
+  """ sorts the matching blocks (i, j, k) and collapses adjacent ones, 
+      as SequenceMatcher does. The sentinel (len_a, len_b, 0) is appended.
+  """
+  blocks.sort()
+  r = []
+  i1 = j1 = k1 = 0
+  for i2, j2, k2 in blocks:
+    if i1 + k1 == i2 and j1 + k1 == j2:
+      k1 += k2
+    else:
+      if k1: r.append((i1, j1, k1))
+      i1, j1, k1 = i2, j2, k2
+  if k1: r.append((i1, j1, k1))
+  r.append((len_a, len_b, 0))
+  return r
+
+class DiffMatcher():
+  """A replacement for difflib.SequenceMatcher(None, a, b, autojunk=False),
+     as far as get_matching_blocks() and get_opcodes() are concerned. The 
+     opcodes have the same format, but come from a different algorithm, 
+     see diff_engines. Unless a and b are already arrays of integer ids (as 
+     returned by WordInterner.ids()), the elements are interned first, so 
+     that the algorithms never call __eq__ of the elements.
+     ratio() and friends are not provided, they are defined in terms of 
+     difflib's own matching.
+  """
+  def __init__(self, a, b, engine='myers'):
+    self.a = a
+    self.b = b
+    self.engine = engine
+    self.matching_blocks = None
+
+  def get_matching_blocks(self):
+    if self.matching_blocks is not None:
+      return self.matching_blocks
+    (a, b) = (self.a, self.b)
+    if not (isinstance(a, array) and isinstance(b, array)):
+      ids = {}
+      a = [ids.setdefault(x, len(ids)) for x in a]
+      b = [ids.setdefault(x, len(ids)) for x in b]
+    blocks = []
+    if self.engine == 'myers':
+      diff_myers(a, b, 0, len(a), 0, len(b), blocks)
+    elif self.engine == 'histogram':
+      diff_histogram(a, b, 0, len(a), 0, len(b), blocks)
+    elif self.engine == 'patience':
+      diff_patience(a, b, 0, len(a), 0, len(b), blocks)
+    else:
+      raise ValueError("unknown diff engine: %s" % self.engine)
+    self.matching_blocks = diff_collapse_blocks(blocks, len(a), len(b))
+    return self.matching_blocks
+
+  def get_opcodes(self):
+    i = j = 0
+    answer = []
+    for ai, bj, size in self.get_matching_blocks():
+      tag = ''
+      if i < ai and j < bj: tag = 'replace'
+      elif i < ai:          tag = 'delete'
+      elif j < bj:          tag = 'insert'
+      if tag:
+        answer.append((tag, i, ai, j, bj))
+      i, j = ai+size, bj+size
+      if size:
+        answer.append(('equal', ai, i, bj, j))
+    return answer
+
+def page_fingerprints(ids, pages):
+  """ splits the word ids of a document into pages, as given by the page 
+      column of its WordTable, which never decreases. Returns a list of 
+      (start, end, fingerprint) per page, the fingerprint is a hash of the
+      page's word ids. Words without a page (.txt or .xml input) are all 
+      on page 0, a single page.
+  """
+  r = []
+  start = 0
+  while start < len(ids):
+    end = bisect.bisect_right(pages, pages[start], start)
+    if isinstance(ids, array): h = hash(ids[start:end].tostring())
+    else:                      h = hash(tuple(ids[start:end]))
+    r.append((start, end, h))
+    start = end
+  return r
+
+class PageAnchoredMatcher(DiffMatcher):
+  """A DiffMatcher that first aligns identical pages of both documents 
+     by their page_fingerprints(). These pages are taken as matching 
+     blocks, the diff engine only runs on the words in the gaps between 
+     them. With a small edit in a large document, most pages are identical, 
+     and the diff is as expensive as the few pages with changes.
+     pages_a and pages_b are the page columns of the WordTables of a and b.
+     The gaps are further cut by diff_split(), the ranges it returns are diffed 
+     independently, by a pool of jobs processes, if there is enough work.
+  """
+  min_pool_words = 5000   # fewer words than this are diffed in this process.
+
+  def __init__(self, a, b, pages_a, pages_b, engine='difflib', jobs=1):
+    DiffMatcher.__init__(self, a, b, engine)
+    self.pages_a = pages_a
+    self.pages_b = pages_b
+    self.jobs = jobs
+
+  def get_matching_blocks(self):
+    if self.matching_blocks is not None:
+      return self.matching_blocks
+    (a, b) = (self.a, self.b)
+    fp_a = page_fingerprints(a, self.pages_a)
+    fp_b = page_fingerprints(b, self.pages_b)
+    anchors = []
+    pm = SequenceMatcher(None, [f[2] for f in fp_a], [f[2] for f in fp_b], autojunk=False)
+    for pi, pj, k in pm.get_matching_blocks():
+      for n in range(k):
+        (sa, ea, h), (sb, eb, h) = fp_a[pi+n], fp_b[pj+n]
+        if a[sa:ea] == b[sb:eb]: anchors.append((sa, ea, sb, eb))
+    if debug: print("PageAnchoredMatcher: %d of %d pages identical" % (len(anchors), len(fp_b)))
+    anchors.append((len(a), len(a), len(b), len(b)))
+    blocks = []
+    ranges = []
+    i = j = 0
+    for sa, ea, sb, eb in anchors:
+      if sa > i and sb > j:
+        ranges += diff_split(a, b, i, sa, j, sb, blocks)
+      if ea > sa: blocks.append((sa, sb, ea-sa))
+      (i, j) = (ea, eb)
+    jobs = [(a[alo:ahi], b[blo:bhi], self.engine) for (alo, ahi, blo, bhi) in ranges]
+    words = sum([ahi-alo+bhi-blo for (alo, ahi, blo, bhi) in ranges])
+    if debug: print("PageAnchoredMatcher: %d ranges, %d words to diff" % (len(ranges), words))
+    pool = None
+    if self.jobs > 1 and len(jobs) > 1 and words >= self.min_pool_words:
+      pool = Pool(self.jobs)
+      results = pool.imap(diff_range, jobs, max(1, len(jobs) // (4*self.jobs)))
+    else:
+      results = (diff_range(job) for job in jobs)
+    for (alo, ahi, blo, bhi), matches in zip(ranges, results):
+      for gi, gj, gk in matches:
+        if gk: blocks.append((alo+gi, blo+gj, gk))
+    if pool is not None:
+      pool.close()
+      pool.join()
+    self.matching_blocks = diff_collapse_blocks(blocks, len(a), len(b))
+    return self.matching_blocks
+
+def sequence_matcher(a, b, engine='difflib'):
+  """ returns a matcher object for the diff engine, see diff_engines.
+      'difflib' is the reference: difflib.SequenceMatcher without autojunk.
+  """
+  if engine == 'difflib':
+    return SequenceMatcher(None, a, b, autojunk=False)
+  return DiffMatcher(a, b, engine)
+
+def word_matcher(ids_a, ids_b, pages_a, pages_b, engine='difflib', jobs=1):
+  """ returns the matcher for the word diff of two documents. The fast engines
+      run in a PageAnchoredMatcher. 'difflib' diffs the whole documents without
+      any anchoring, so that it remains the reference to cross-check them.
+  """
+  if engine == 'difflib':
+    return sequence_matcher(ids_a, ids_b, engine)
+  return PageAnchoredMatcher(ids_a, ids_b, pages_a, pages_b, engine, jobs)
+
+def move_candidates(seqs_a, seqs_b, similarity):
+  """ returns a sorted list of all index pairs (i, j), where seqs_a[i] and 
+      seqs_b[j] may have a SequenceMatcher.ratio() >= similarity. 
+      All other pairs are guaranteed to fail.
+      ratio() is 2*M/(len_a+len_b), where the number of matches M cannot 
+      exceed the number of words both sequences have in common (counted 
+      with multiplicity). This is a set similarity join: each sequence 
+      becomes a set of (word, occurrence number) elements, sorted by their 
+      rarity. Two sets can only reach the similarity, if they share one 
+      of the first few, rare elements, the prefix. Only the prefixes 
+      are indexed and probed.
+  """
+  if similarity <= 0:
+    return [(i, j) for i in range(len(seqs_a)) for j in range(len(seqs_b))]
+  if similarity > 1:
+    return []
+
+  def elements(seq):
+    seen = {}
+    el = []
+    for t in seq:
+      n = seen.get(t, 0)
+      seen[t] = n+1
+      el.append((t, n))
+    return el
+
+  el_a = [elements(seq) for seq in seqs_a]
+  el_b = [elements(seq) for seq in seqs_b]
+  freq = {}
+  for el in el_a + el_b:
+    for e in el:
+      freq[e] = freq.get(e, 0) + 1
+
+  def prefix(el):
+    # at least this many elements must be shared, whatever the other 
+    # sequence is. The epsilon errs towards a longer prefix.
+    need = int(math.ceil(similarity*len(el)/(2.0-similarity) - 1e-9))
+    el.sort(key=lambda e: (freq[e], e))
+    return el[:len(el)-max(need, 1)+1]
+
+  index = {}
+  for j, el in enumerate(el_b):
+    for e in prefix(el):
+      index.setdefault(e, []).append(j)
+  pairs = set()
+  for i, el in enumerate(el_a):
+    for e in prefix(el):
+      for j in index.get(e, ()):
+        pairs.add((i, j))
+  return sorted(pairs)
+
+def spell_check_words(words, jobs=1, cache_dir=None):
+  """ checks words with hunspell, returns a dict of the bad words and their 
+      suggestions, as Hunspell.check_words() does. The words are split into 
+      shards of at least spell_min_shard words, up to jobs hunspell processes 
+      check them in parallel. The processes are kept for the next call.
+      With cache_dir, the verdicts are kept there in a file per dictionary 
+      set and hunspell version. Only words not found there go to hunspell.
+      Words known to hunspell_dict are not checked at all, they are good.
+  """
+  global hunspell_dict
+  while len(hunspell_checkers) < max(1, jobs):
+    hunspell_checkers.append(Hunspell(dicts=None))
+  if hunspell_dict is None:
+    try:
+      hunspell_dict = HunspellDict(hunspell_checkers[0].dicts_loaded())
+    except (IOError, OSError, KeyError) as e:
+      print("spell check: dictionary files not loaded, all words go to hunspell: %s" % e)
+      hunspell_dict = HunspellDict()
+  words = hunspell_dict.unknown_words(words)
+  cache = None
+  todo = words
+  if cache_dir:
+    h = hunspell_checkers[0]
+    h.check_words([])         # starts hunspell, we need its version.
+    key = hashlib.sha1(repr((h.version, h.dicts_loaded()))).hexdigest()[:16]
+    fname = os.path.join(cache_dir, 'hunspell_%s.json' % key)
+    try:
+      cache = json.load(open(fname))
+    except (IOError, ValueError):
+      cache = {}
+    todo = [w for w in words if not w in cache]
+    print("spell check cache: %d of %d words known" % (len(words)-len(todo), len(words)))
+
+  n = max(1, min(jobs, len(todo) // spell_min_shard))
+  results = [{}] * n
+  def shard(k):
+    results[k] = hunspell_checkers[k].check_words(todo[k::n])
+  threads = [threading.Thread(target=shard, args=(k,)) for k in range(1, n)]
+  for t in threads: t.start()
+  if len(todo): shard(0)
+  for t in threads: t.join()
+  bad_words = {}
+  for r in results: bad_words.update(r)
+  if cache is None:
+    return bad_words
+
+  for w in todo: cache[w] = bad_words.get(w)
+  try:
+    with open(fname + '.tmp', 'w') as f:
+      json.dump(cache, f)
+    os.rename(fname + '.tmp', fname)
+  except (IOError, OSError) as e:
+    print("spell check cache %s not written: %s" % (fname, e))
+  for w in words:
+    if cache[w] is not None: bad_words[w] = cache[w]
+  return bad_words
+
+def pdfhtml_xml_find(dom, re_pattern=None, wordlist=None, search_terms=None, nocase=False, ext={}, first_page=None, last_page=None, mark_ops="D,A,C", margins=None, strict=False, spell_check=False, move_similarity=0.95, move_minwords=10, diff_engine='difflib', jobs=1, cache_dir=None):
   """traverse the XML dom tree, (which is expected to come from pdf2html -xml)
+     dom can also be a page stream from pdf2xml_pages(), it is traversed only once.
      find all occurances of re_pattern on all pages, returning rect list for 
      each page, giving the exact coordinates of the bounding box of all 
      occurances. Font metrics are used to interpolate into the line fragments 
      found in the dom tree.
      Keys and values from ext['e'] are merged into the DecoratedWord output for pattern matches and spell check findings.
+     re_pattern can also be a list of patterns, search_terms is a list of literal 
+     terms to find as well. All are compiled into one SearchMatcher, each mark 
+     carries the id of its term in 'term'. re_pattern may also be a SearchMatcher.
      If re_pattern is None, then wordlist is used instead. 
      Keys and values from ext['a'], ext['d'], or ext['c'] respectively are merged into 
      the DecoratedWord output for added, deleted, or changed texts (respectivly).
      mark_ops defines which diff operations are marked.
+     diff_engine selects the algorithm for the word diff, see diff_engines.
+     jobs > 1 diffs the independent ranges of a large diff in parallel, see PageAnchoredMatcher,
+     and runs as many hunspell processes for spell_check. The spelling verdicts are cached
+     in cache_dir, see spell_check_words().
   """
 
   ######
   def markword(r_dict, wl, idx, attr, fontinfo):
-    w = wl[idx]
-    p_nr = w[3].get('p','?')
-    l = len(w[0])
-    off = w[2]
+    # wl is a WordTable, we use its columns directly.
+    l = len(wl.word(idx))
+    off = wl.off[idx]
     if attr['t'] == 'del' or attr['t'] == 'del-mov':
       # l=0 special case:
       # very small marker length triggers extenders.
@@ -1146,22 +3444,20 @@ def pdfhtml_xml_find(dom, re_pattern=None, wordlist=None, nocase=False, ext={},
       #  if decrementable (idx > 1), place the marker at the end of the previous word, 
       #  not at the beginning of this word.
       if idx > 0:
-         w = wl[idx-1]
-         p_nr = w[3].get('p','?')
-         off = w[2]+len(w[0])
+         idx -= 1
+         off = wl.off[idx]+len(wl.word(idx))
       l = 0 
+    p_nr = wl.page_nr(idx) or '?'
+    r = wl.run[idx]
 
-    mark = create_mark(w[1], off, l,
-          fontinfo[p_nr][w[3]['f']]['font'], 
-          w[3]['x'],w[3]['y'],w[3]['w'],w[3]['h'], attr)
+    mark = create_mark(wl.text[r], off, l,
+          fontinfo[p_nr][wl.font[r]]['font'], 
+          wl.x[r],wl.y[r],wl.w[r],wl.h[r], attr)
     if not p_nr in r_dict: r_dict[p_nr] = []
     r_dict[p_nr].append(mark)
 
   def catwords_raw(dw, idx1, idx2):
-    text = ""
-    for w in dw[idx1:idx2]:
-      text += w[0] + " "
-    return text[:-1]    # chop off trailing whitespace
+    return " ".join([dw.word(i) for i in range(idx1, idx2)])
 
   def catwords(dw, idx1, idx2, maxwords=666):
     # make maxwords low enough, so that the popup fits on the screen.
@@ -1175,16 +3471,17 @@ def pdfhtml_xml_find(dom, re_pattern=None, wordlist=None, nocase=False, ext={},
     llen=0
     ypos=None
     p_nr=None
-    for w in dw[idx1:idx2]:
+    for i in range(idx1, idx2):
+      word = dw.word(i)
       if p_nr is None:
-        p_nr = w[3].get('p','')
+        p_nr = dw.page_nr(i)
       if ypos is None:
-        ypos = w[3].get('y','')
-      if 'p' in w[3] and p_nr != w[3]['p']:
-        p_nr = w[3]['p']
+        ypos = dw.run_y(i)
+      if dw.page[i] and p_nr != dw.page[i]:
+        p_nr = dw.page[i]
         text += " <br> --]page:%d[--" % int(p_nr)
         llen=1000 # fallthrough
-      if llen > 100 or ypos != w[3].get('y',''):
+      if llen > 100 or ypos != dw.run_y(i):
         # silly hack for okular. It does not do line wrapping on its own.
         # evince and acroread do it. Okular wraps the line, when I say <br>, 
         # but the others will then print out "<br>". 
@@ -1192,36 +3489,75 @@ def pdfhtml_xml_find(dom, re_pattern=None, wordlist=None, nocase=False, ext={},
         # These URL annotations are not meant to contain html code. 
         text += " <br> "
         llen = 0
-        ypos = w[3].get('y','')
+        ypos = dw.run_y(i)
       elif llen > 0:
         text += " "
         llen += 1
-      text += w[0]
-      llen += len(w[0])
-    if 'p' in dw[idx1][3]:
-      page_or_elem = 'p'+str(dw[idx1][3]['p'])
-    elif 'e' in dw[idx1][3]:
-      page_or_elem = 'e'+str(dw[idx1][3]['e'])
-    else:
-      page_or_elem = '#'
-    loc_or_lineno = dw[idx1][3].get('l','')
-    if isinstance(loc_or_lineno, int):
-      loc_or_lineno = 'l'+str(loc_or_lineno)
-    return [text, page_or_elem+loc_or_lineno]
+      text += word
+      llen += len(word)
+    return [text, dw.location(idx1)]
+
+  def searchpage(p, p_finfo):
+    p_rect = []
+    for e in p.findall('text'):
+      text = ''.join(e.itertext())
+      if not strict:
+        text = zap_letter_spacing(text)
+
+      p_rect += search_marks(matcher, text, p_finfo[int(e.attrib['font'])]['font'], 
+        float(e.attrib['left']), float(e.attrib['top']), 
+        float(e.attrib['width']),float(e.attrib['height']), ext['e'])
+    return p_rect
   ######
 
-  fontinfo = xml2fontinfo(dom, last_page)
+  ## A single pass through all pages collects fonts, words, page geometry, and
+  ## search results. With a page stream from pdf2xml_pages() each page is 
+  ## discarded after this pass.
+  matcher = None
+  if isinstance(re_pattern, SearchMatcher):
+    matcher = re_pattern
+  elif re_pattern or search_terms:
+    if not isinstance(re_pattern, list): re_pattern = [re_pattern] if re_pattern else []
+    matcher = SearchMatcher(re_pattern, search_terms or [], nocase)
+  fontinfo = [None]     # as in xml2fontinfo()
+  p_finfo = {}
+  # words of this document share the interner with the given wordlist.
+  wl_new = WordTable(wordlist.interner if wordlist else None)
+  pages_a = []
+  if first_page is None: first_page = 0
+  p_nr = 0
+  for p in dom_pages(dom):
+    if not last_page is None:
+      if p_nr > int(last_page):
+        break
+    p_nr += 1
+    p_finfo = xml_page_fontinfo(p, p_finfo)
+    fontinfo.append(p_finfo)
+    if (wordlist or spell_check) and p_nr > int(first_page):
+      # generate our wordlist too, so that we can diff against the given wordlist or spell_check.
+      xml_page_wordlist(p, p_nr, margins, wl_new)
+    p_rect = []
+    if matcher is not None:
+      p_rect = searchpage(p, p_finfo)
+    pages_a.append({'nr':int(p.attrib['number']), 'rect':p_rect, 'p_nr':p_nr,
+                 'nav_c':ext['e'].get('c',[.5,.5,.5]),
+                 'h':float(p.attrib['height']), 'w':float(p.attrib['width']),
+                 'x':float(p.attrib['left']), 'y':float(p.attrib['top'])})
+  if wordlist or spell_check:
+    print("xml2wordlist: %d pages" % (p_nr-int(first_page)))
 
   ops = {}
   for op in mark_ops.split(','):
     ops[op[0].lower()] = 1
 
   p_rect_dict = {}   # indexed by page numbers, then lists of marks
-  if wordlist or spell_check:
-    # generate our wordlist too, so that we can diff against the given wordlist or spell_check.
-    wl_new = xml2wordlist(dom, first_page, last_page, margins=margins)
   if wordlist:
-    s = SequenceMatcher(None, wordlist, wl_new, autojunk=False)
+    # the diff runs on integer ids, the other columns of wordlist and wl_new
+    # hold the positional metadata of each word.
+    interner = wl_new.interner
+    ids_old = interner.ids(wordlist)
+    ids_new = interner.ids(wl_new)
+    s = word_matcher(ids_old, ids_new, wordlist.page, wl_new.page, diff_engine, jobs)
     # print("SequenceMatcher done")     # this means nothing... s.get_opcodes() takes ages!
 
     def opcodes_find_moved(iter_list):
@@ -1244,21 +3580,44 @@ def pdfhtml_xml_find(dom, re_pattern=None, wordlist=None, nocase=False, ext={},
         all = []
         for tag, i1, i2, j1, j2 in iter_list:
           all.append((tag, i1, i2, j1, j2, {}))
-        for tag, i1, i2, j1, j2, hint in all:
-          for tagb, i1b, i2b, j1b, j2b, hintb in all:
-            if (tag == 'insert' and tagb == 'delete' and 
-                (i2b-i1b) > move_minwords and 
-                (j2 - j1) > move_minwords):
-              list_ins = wl_new[j1:j2]
-              list_del = wordlist[i1b:i2b]
-              ## could also use levenshtein() to compute a distance.
-              sm = SequenceMatcher(None, list_ins, list_del, autojunk=False)
-              r = sm.ratio()
-              if r >= move_similarity:
-                if not 'ref' in hint:  hint['ref'] = []
-                if not 'ref' in hintb: hintb['ref'] = []
-                hint['ref'].append((r, i1b, i2b))   # wordlist[..]
-                hintb['ref'].append((r, j1, j2))    # wl_new[..]
+        # comparing all inserts with all deletes would be quadratic.
+        # move_candidates() gives us the pairs worth a closer look.
+        # Then tiers of cheap upper bounds reject most of them before ratio().
+        ins = [op for op in all if op[0] == 'insert' and (op[4]-op[3]) > move_minwords]
+        dels = [op for op in all if op[0] == 'delete' and (op[2]-op[1]) > move_minwords]
+        cand = move_candidates([ids_new[op[3]:op[4]] for op in ins], 
+                               [ids_old[op[1]:op[2]] for op in dels], move_similarity)
+        rejected = {'index':len(ins)*len(dels)-len(cand), 'length':0, 'quick_ratio':0, 'ratio':0}
+        sm_del = {}     # reused per delete, SequenceMatcher caches its analysis of seq2.
+        for a, b in cand:
+          tag, i1, i2, j1, j2, hint = ins[a]
+          tagb, i1b, i2b, j1b, j2b, hintb = dels[b]
+          # same as real_quick_ratio(), without constructing anything.
+          if 2.0*min(j2-j1, i2b-i1b)/(j2-j1+i2b-i1b) < move_similarity:
+            rejected['length'] += 1
+            continue
+          list_ins = ids_new[j1:j2]
+          if not b in sm_del:
+            sm_del[b] = SequenceMatcher(None, [], ids_old[i1b:i2b], autojunk=False)
+          ## could also use levenshtein() to compute a distance.
+          sm = sm_del[b]
+          sm.set_seq1(list_ins)
+          if sm.quick_ratio() < move_similarity:
+            # bag of words bound
+            rejected['quick_ratio'] += 1
+            continue
+          r = sm.ratio()
+          if r >= move_similarity:
+            if not 'ref' in hint:  hint['ref'] = []
+            if not 'ref' in hintb: hintb['ref'] = []
+            hint['ref'].append((r, i1b, i2b))   # wordlist[..]
+            hintb['ref'].append((r, j1, j2))    # wl_new[..]
+          else:
+            rejected['ratio'] += 1
+        if debug:
+          print(" ... %d insert/delete pairs rejected by index: %d, length: %d, quick_ratio: %d, ratio: %d; accepted: %d" % 
+                (len(ins)*len(dels), rejected['index'], rejected['length'], rejected['quick_ratio'], rejected['ratio'],
+                 len(cand)-rejected['length']-rejected['quick_ratio']-rejected['ratio']))
       
         print(" ... sorting ...")
       
@@ -1278,7 +3637,7 @@ def pdfhtml_xml_find(dom, re_pattern=None, wordlist=None, nocase=False, ext={},
             i2b = hint['ref'][0][2]
             # print ["add new", catwords(wl_new, j1, j2)]
             # print ["add ref", catwords(wordlist, i1b, i2b)]
-            sm_2 = SequenceMatcher(None, wordlist[i1b:i2b], wl_new[j1:j2], autojunk=False)
+            sm_2 = sequence_matcher(ids_old[i1b:i2b], ids_new[j1:j2], diff_engine)
             for tag_2, i1_2, i2_2, j1_2, j2_2 in sm_2.get_opcodes():
               if tag_2 == "equal": 
                 tag_2 = "move"
@@ -1303,8 +3662,8 @@ def pdfhtml_xml_find(dom, re_pattern=None, wordlist=None, nocase=False, ext={},
           i_len = i2-i1
           j_len = j2-j1
           if not strict:
-            cat_i = "".join(map(lambda x: x[0]+'?', wordlist[i1:i2]))
-            cat_j = "".join(map(lambda x: x[0]+'?', wl_new[j1:j2]))
+            cat_i = "".join([wordlist.word(i)+'?' for i in range(i1, i2)])
+            cat_j = "".join([wl_new.word(j)+'?' for j in range(j1, j2)])
             nohyp_i = re.sub("\-\?","",cat_i)
             nohyp_j = re.sub("\-\?","",cat_j)
             if (nohyp_i == nohyp_j):
@@ -1315,8 +3674,8 @@ def pdfhtml_xml_find(dom, re_pattern=None, wordlist=None, nocase=False, ext={},
               continue     
 
             if (i_len > 1 and j_len > 1):
-              mi = re.match("[\._=-]{7,}$", wordlist[i1][0])
-              mj = re.match("[\._=-]{7,}$", wl_new[j1][0])
+              mi = re.match("[\._=-]{7,}$", wordlist.word(i1))
+              mj = re.match("[\._=-]{7,}$", wl_new.word(j1))
               if mi and mj:
                 i1 = i1+1
                 j1 = j1+1
@@ -1397,85 +3756,37 @@ def pdfhtml_xml_find(dom, re_pattern=None, wordlist=None, nocase=False, ext={},
         markword(p_rect_dict, wl_new, j, attr, fontinfo)
 
   if spell_check:
-    h = Hunspell(dicts=None)
-    word_set = set()
-    for word in wl_new:
-      m = re.search('([a-z_-]{3,})', word[0], re.I)
+    stems = {}        # indexed by token id
+    for tok in set(wl_new.tok):
+      m = re.search('([a-z_-]{3,})', wl_new.interner.strings[tok], re.I)
       if m:
         # preserve capitalization. hunspell handles that nicely.
-        stem = m.group(1)
-        word_set.add(stem)
-        if not 's' in word[3]: word[3]['s'] = {}
-        word[3]['s'][word[2]] = stem
+        stems[tok] = m.group(1)
+    word_set = set(stems.values())
     print("%d words to check" % len(word_set))
-    bad_word_dict = h.check_words(word_set) 
+    bad_word_dict = spell_check_words(word_set, jobs, cache_dir)
     print("checked: %d bad" % len(bad_word_dict))
     if debug > 1:
         pprint(['bad_word_dict: ', bad_word_dict])
       
-    idx = 0
-    for word in wl_new:
-      if 's' in word[3] and \
-        word[2] in word[3]['s'] and \
-        word[3]['s'][word[2]] in bad_word_dict:
+    for idx in range(len(wl_new)):
+      stem = stems.get(wl_new.tok[idx])
+      if stem is not None and stem in bad_word_dict:
         attr = ext['e'].copy()
-        stem = word[3]['s'][word[2]]
         # suggest = map(lambda x: urllib.quote_plus(x), bad_word_dict[stem])
         suggest = [urllib.quote_plus(x) for x in bad_word_dict[stem]]
         if not len(suggest): suggest = ['???']
         attr['o'] = "("+urllib.quote_plus(stem)+") -> " + (", ".join(suggest))
         attr['t'] = "spl"
         markword(p_rect_dict, wl_new, idx, attr, fontinfo)
-      idx += 1
 
   # End of wordlist code.
   # We have now p_rect_dict preloaded with the wordlist marks or empty.
   # next loop through all pages, select the correct p_rect from the dict.
-  # Start or continue adding re_pattern search results while if any.
-  # Finally collect all in pages_a.in pages_a.
-  pages_a = []
-  p_nr = 0
-  for p in dom.findall('page'):
-    if not last_page is None:
-      if p_nr > int(last_page):
-        break
-    p_nr += 1
-
-    p_rect = p_rect_dict.get(p_nr,[])
-    if re_pattern:
-      for e in p.findall('text'):
-        p_finfo = fontinfo[p_nr]
-        text = ''
-        for t in e.itertext(): text += t
-        if not strict:
-          text = zap_letter_spacing(text)
-  
-        #pprint([e.attrib, text])
-        #print("search (%s)" % re_pattern)
-        flags = re.UNICODE
-        if (nocase): flags |= re.IGNORECASE
-        # l = map(lambda x:len(x), re.split('('+re_pattern+')', text, flags=flags))
-        l = [len(x) for x in re.split('('+re_pattern+')', text, flags=flags)]
-        l.append(0)       # dummy to make an even number.
-        # all odd indices in l are word lengths, all even ones are seperator lengths
-        offset = 0
-        i = 0
-        while (i < len(l)):
-          # print("offset=%d, i=%d, l=%s" % (offset, i, repr(l)))
-          offset += l[i]
-          if (l[i+1] > 0):
-  
-            p_rect.append(create_mark(text,offset,l[i+1], 
-              p_finfo[e.attrib['font']]['font'], 
-              e.attrib['left'], e.attrib['top'], 
-              e.attrib['width'],e.attrib['height'], ext['e']))
-    
-            offset += l[i+1]
-          i += 2
-    pages_a.append({'nr':int(p.attrib['number']), 'rect':p_rect, 
-                 'nav_c':ext['e'].get('c',[.5,.5,.5]),
-                 'h':float(p.attrib['height']), 'w':float(p.attrib['width']),
-                 'x':float(p.attrib['left']), 'y':float(p.attrib['top'])})
+  # and append the re_pattern search results collected in the page scan above.
+  for pg in pages_a:
+    pg['rect'] = p_rect_dict.get(pg['p_nr'],[]) + pg['rect']
+    del pg['p_nr']
   return pages_a
 
 
@@ -1491,10 +3802,11 @@ class Hunspell():
         self.dicts = dicts
         self.proc = None
         self.attr = None
-        self.buffer = ''
+        self.buffer = bytearray()
+        self.pos = 0
 
     def _start(self):
-        cmd = self.cmd
+        cmd = list(self.cmd)
         if self.dicts is not None and len(self.dicts): 
             cmd += ['-d', ','.join(self.dicts)]
         try:
@@ -1503,9 +3815,15 @@ class Hunspell():
         except OSError as e:
             self.proc = "%s failed: errno=%d %s" % (cmd, e.errno, e.strerror)
             raise OSError(self.proc)
+        self.buffer = bytearray()
+        self.pos = 0
         header = ''
         while True:
-            more = self.proc.stdout.readline().rstrip()
+            more = self._readline()
+            if not len(more):
+                self.proc = "%s failed: no version line" % cmd
+                raise OSError(self.proc)
+            more = more.rstrip()
             if len(more) > 5 and more[0:5] == '@(#) ':    # version line with -a
                 self.version = more[5:]
                 break
@@ -1515,29 +3833,41 @@ class Hunspell():
             else:
                 header += more  # stderr should be collected here. It does not work
         if len(header): self.header = header
-        self.buffer = ''
         
     def _readline(self):
         # python readline() is horribly stupid on this pipe. It reads single
         # byte, just like java did in the 1980ies. Sorry, this is not
         # acceptable in 2013.
+        # We read whatever the pipe has into a bytearray, and only advance 
+        # self.pos over the lines returned. The consumed head is cut off, 
+        # when it is more than half of the buffer.
         if self.proc is None:
-            raise Error("Hunspell_readline before _start")
+            raise OSError("Hunspell._readline before _start")
         while True:
-            idx = self.buffer.find('\n')
-            if idx < 0:
-                more = self.proc.stdout.read()
-                if not len(more):
-                    r = self.buffer
-                    self.buffer = ''
-                    return r
-                self.buffer += more
-            else:
+            idx = self.buffer.find('\n', self.pos)
+            if idx >= 0:
                 break
-        r = self.buffer[0:idx+1]
-        self.buffer = self.buffer[idx+1:]
+            more = os.read(self.proc.stdout.fileno(), 65536)
+            if not len(more):
+                r = str(self.buffer[self.pos:])
+                self.buffer = bytearray()
+                self.pos = 0
+                return r
+            if self.pos > len(self.buffer) // 2:
+                del self.buffer[:self.pos]
+                self.pos = 0
+            self.buffer += more
+        r = str(self.buffer[self.pos:idx+1])
+        self.pos = idx+1
         return r
 
+    def close(self):
+        """terminates the hunspell process. The next check_words() starts a new one."""
+        if hasattr(self.proc, 'poll'):
+            self.proc.stdin.close()
+            self.proc.wait()
+        self.proc = None
+
     def _load_attr(self):
         try:
             p = subprocess.Popen(self.cmd + ['-D'], shell=False, 
@@ -1597,30 +3927,45 @@ class Hunspell():
         if self.attr is None: self._load_attr()
         return self.attr['LOADED DICTIONARY']
  
-    def check_words(self, words):
+    def check_words(self, words, batch=1000):
         """takes a list of words as parameter, and checks them against the 
            loaded spelling dictionaries. A key value dict is returned, where
            every key represents a word that was not found in the 
            spelling dictionaries. Values are lists of correction suggestions.
            check_words() is implemented by calling the hunspell binary in pipe mode.
-           This is fairly robust, but not optimized for efficiency.
+           The hunspell process is started once, and reused by the next call.
+           A writer thread feeds it batch words per write, while we read the 
+           replies. Each input line is answered by an empty line, this tells
+           us when all words are done.
         """
-        if self.proc is None:
+        if not hasattr(self.proc, 'poll') or self.proc.poll() is not None:
             self._start()
-        childpid = os.fork()
-        if childpid == 0:
-            for w in words:
-                self.proc.stdin.write(("^"+w+"\n").encode('utf8'))
-            os._exit(0)
-        self.proc.stdin.close()
+        lines = [("^"+w.replace('\n', ' ')+"\n").encode('utf8') for w in words]
+        stdin = self.proc.stdin
+        def writer():
+            try:
+                for i in range(0, len(lines), batch):
+                    stdin.write(''.join(lines[i:i+batch]))
+                    stdin.flush()
+            except IOError:
+                pass    # hunspell is gone, the reader sees end of file.
+        t = threading.Thread(target=writer)
+        t.daemon = True
+        t.start()
         bad_words = {}
+        pending = len(lines)
  
-        while True:
+        while pending:
             line = self._readline()
             if len(line) == 0:
+                print("hunspell terminated, %d words unchecked" % pending)
+                self.proc = None
                 break
             line = line.rstrip()
-            if not len(line) or line[0] in '*+-': continue
+            if not len(line):
+                pending -= 1
+                continue
+            if line[0] in '*+-': continue
  
             if line[0] == '#': 
                 car = line.split(' ')
@@ -1636,8 +3981,160 @@ class Hunspell():
                 bad_words[car[1]] = cdr
             else:
                 print("bad hunspell reply: %s, split as %s" % (line, a))
-        self.proc = None
+        t.join()
         return bad_words
 
-if __name__ == "__main__": main()
+class HunspellDict():
+    """An in-process word list, loaded from the .dic/.aff files that hunspell uses.
+       The affix rules are expanded when loading, so that known() is a plain
+       set lookup. This is only a positive check: a word found here is known
+       to hunspell. Everything else (compounds, continuation classes, 
+       suggestions) is left to the hunspell process, see unknown_words().
+       If you pass wordlists=None, the personal dictionaries ~/.hunspell_<name> 
+       of the loaded dictionaries are added.
+    """
+    def __init__(self, dics=[], wordlists=None):
+        self.words = set()
+        self.forbidden = set()
+        seen = []
+        for d in dics:
+            base = re.sub('\.(dic|aff)$', '', d)
+            if not base in seen: seen.append(base)
+        for base in seen:
+            self.load_dic(base + '.dic', base + '.aff')
+        if wordlists is None:
+            wordlists = [os.path.expanduser('~/.hunspell_' + os.path.basename(b)) for b in seen]
+            wordlists = [w for w in wordlists if os.path.exists(w)]
+        for w in wordlists:
+            self.load_wordlist(w)
+
+    def __len__(self):
+        return len(self.words)
+
+    def _decode(self, data, enc):
+        enc = enc.lower().replace('microsoft-', '')
+        try:
+            codecs.lookup(enc)
+        except LookupError:
+            enc = 'latin-1'
+        return data.decode(enc, 'replace')
+
+    def _flags(self, s, flag_type, aliases):
+        if aliases and s.isdigit():
+            return aliases[int(s)-1] if 0 < int(s) <= len(aliases) else []
+        if flag_type == 'long':
+            return [s[i:i+2] for i in range(0, len(s), 2)]
+        if flag_type == 'num':
+            return s.split(',')
+        return list(s)
+
+    def _condition(self, cond, kind):
+        if cond == '.': return None
+        # hunspell conditions only know '.', '[...]' and '[^...]'.
+        r = ''.join([c if c in '.[]^' else re.escape(c) for c in cond])
+        if kind == 'SFX': return re.compile(r + '$', re.U)
+        return re.compile('^' + r, re.U)
+
+    def load_dic(self, dic, aff=None):
+        """adds the words of a hunspell .dic file, expanded with the prefix and suffix 
+           rules of its .aff file. Affix rules with continuation classes are applied 
+           once, without the continuation.
+        """
+        flag_type = 'char'
+        aliases = None
+        rules = {}      # flag: (kind, cross_product, [(strip, append, condition), ...])
+        special = {}
+        enc = 'ISO8859-1'
+        if aff is not None and os.path.exists(aff):
+            data = open(aff, 'rb').read()
+            m = re.search(r'^SET\s+(\S+)', data, re.M)
+            if m: enc = m.group(1)
+            for line in self._decode(data, enc).split('\n'):
+                a = line.split()
+                if not len(a) or a[0][0] == '#': continue
+                if a[0] == 'FLAG' and len(a) > 1:
+                    flag_type = a[1].lower()
+                elif a[0] == 'AF' and len(a) > 1:
+                    if aliases is None: aliases = []            # AF <count>
+                    else: aliases.append(self._flags(a[1], flag_type, None))
+                elif a[0] in ('NEEDAFFIX', 'PSEUDOROOT', 'ONLYINCOMPOUND', 'FORBIDDENWORD') and len(a) > 1:
+                    special[a[0]] = a[1]
+                elif a[0] in ('PFX', 'SFX') and len(a) >= 4:
+                    if not a[1] in rules:
+                        rules[a[1]] = (a[0], a[2] == 'Y', [])     # PFX <flag> <Y|N> <count>
+                        continue
+                    strip = '' if a[2] == '0' else a[2]
+                    append = a[3].split('/')[0]
+                    if append == '0': append = ''
+                    cond = self._condition(a[4] if len(a) > 4 else '.', a[0])
+                    rules[a[1]][2].append((strip, append, cond))
+        no_root = set([special.get('NEEDAFFIX'), special.get('PSEUDOROOT'), special.get('ONLYINCOMPOUND')])
+        no_root.discard(None)
+        forbidden = special.get('FORBIDDENWORD')
+
+        lines = self._decode(open(dic, 'rb').read(), enc).split('\n')
+        if len(lines) and lines[0].strip().isdigit(): lines = lines[1:]
+        words = self.words
+        for line in lines:
+            a = line.split()
+            if not len(a): continue
+            word, slash, fl = a[0].partition('/')
+            flags = self._flags(fl, flag_type, aliases) if slash else []
+            if forbidden in flags:
+                self.forbidden.add(word)
+                continue
+            if not no_root.intersection(flags):
+                words.add(word)
+            crossed = [word]
+            for f in flags:
+                r = rules.get(f)
+                if r is None or r[0] != 'SFX': continue
+                for strip, append, cond in r[2]:
+                    if word.endswith(strip) and (cond is None or cond.search(word)):
+                        w = word[:len(word)-len(strip)] + append
+                        words.add(w)
+                        if r[1]: crossed.append(w)
+            for f in flags:
+                r = rules.get(f)
+                if r is None or r[0] != 'PFX': continue
+                for strip, append, cond in r[2]:
+                    for w in (crossed if r[1] else [word]):
+                        if w.startswith(strip) and (cond is None or cond.search(w)):
+                            words.add(append + w[len(strip):])
+        words -= self.forbidden
+
+    def load_wordlist(self, fname):
+        """adds the words of a plain word list, one per line. This is the format
+           of the personal dictionaries, where '*word' forbids a word.
+        """
+        for line in codecs.open(fname, 'r', 'utf8', 'replace'):
+            word = line.strip().split('/')[0]
+            if not len(word): continue
+            if word[0] == '*':
+                self.forbidden.add(word[1:])
+                self.words.discard(word[1:])
+            else:
+                self.words.add(word)
+
+    def known(self, word):
+        """True, if word or its lowercase or capitalized form is in the dictionary,
+           following the capitalization rules of hunspell.
+        """
+        if isinstance(word, str): word = word.decode('utf8', 'replace')
+        if word in self.words: return True
+        if word in self.forbidden: return False
+        lower = word.lower()
+        if word[1:] == lower[1:] and lower in self.words: return True     # Capitalized
+        if word.isupper():
+            return lower in self.words or lower.capitalize() in self.words
+        return False
+
+    def unknown_words(self, words):
+        """returns the list of words that are not known(). Only these need to be
+           checked by the hunspell process.
+        """
+        return [w for w in words if not self.known(w)]
+
+
+if __name__ == "__main__": sys.exit(main())
 
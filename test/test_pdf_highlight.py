@@ -0,0 +1,255 @@
+#!/usr/bin/python 
+# -*- coding: utf-8 -*-
+
+import xml.etree.cElementTree as ET
+import pdf_highlight
+
+
+def fake_pdftohtml(first, last, fonts_by_page):
+         """
+         Mimics pdftohtml -xml -f first -l last: fonts are numbered per run,
+         a fontspec is emitted on the first page that uses the font.
+         """
+         fonts = []
+         xml = '<pdf2xml>\n'
+         for n in range(first, last+1):
+                  xml += '<page number="%d" top="0" left="0" height="100" width="100">\n' % n
+                  for f in fonts_by_page[n]:
+                           if f not in fonts:
+                                    fonts.append(f)
+                                    xml += '\t<fontspec id="%d" size="%s" family="%s" color="#000000"/>\n' % (len(fonts)-1, f[1], f[0])
+                  for f in fonts_by_page[n]:
+                           xml += '<text top="1" left="1" width="9" height="9" font="%d">p%d</text>\n' % (fonts.index(f), n)
+                  xml += '</page>\n'
+         return ET.ElementTree(ET.fromstring(xml + '</pdf2xml>\n'))
+
+
+def test_pdf2xml_stitch():
+         """
+         Checks, that page range chunks stitch back to a single run dom.
+         """
+         fonts_by_page = {}
+         for n in range(1, 31):
+                  fonts_by_page[n] = [('Times', 12), ('Helvetica', 8 + n % 5), ('Courier', n // 10)]
+         single = fake_pdftohtml(1, 30, fonts_by_page)
+         chunks = [fake_pdftohtml(f, min(f+6, 30), fonts_by_page) for f in range(1, 31, 7)]
+         stitched = pdf_highlight.pdf2xml_stitch(chunks)
+         assert ET.tostring(stitched.getroot()) == ET.tostring(single.getroot())
+
+
+def test_pdf2xml_ranges():
+         assert pdf_highlight.pdf2xml_ranges(None, None, 60, None, 4) == [('1', '20'), ('21', '40'), ('41', '60')]
+         assert pdf_highlight.pdf2xml_ranges('5', '12', 60, 3) == [('5', '7'), ('8', '10'), ('11', '12')]
+         assert pdf_highlight.pdf2xml_ranges(None, None, None, 3) == [(None, None)]
+         assert pdf_highlight.pdf2xml_ranges('3', None, 60, 0) == [('3', None)]
+
+
+def lcs_length(a, b):
+         prev = [0] * (len(b)+1)
+         for x in a:
+                  cur = [0]
+                  for j, y in enumerate(b):
+                           cur.append(prev[j]+1 if x == y else max(prev[j+1], cur[j]))
+                  prev = cur
+         return prev[-1]
+
+
+def test_diff_engines():
+         """
+         Checks, that all diff engines produce valid opcodes, and that
+         myers finds a longest common subsequence.
+         """
+         import random
+         rnd = random.Random(42)
+         for t in range(500):
+                  k = rnd.randint(1, 8)
+                  a = [rnd.randint(0, k) for i in range(rnd.randint(0, 30))]
+                  b = [x for x in a if rnd.random() < 0.8] + [rnd.randint(0, k) for i in range(rnd.randint(0, 5))]
+                  for engine in pdf_highlight.diff_engines:
+                           i = j = matched = 0
+                           new = []
+                           for tag, i1, i2, j1, j2 in pdf_highlight.sequence_matcher(a, b, engine).get_opcodes():
+                                    assert (i1, j1) == (i, j)
+                                    if tag == 'equal':
+                                             assert a[i1:i2] == b[j1:j2]
+                                             matched += i2-i1
+                                    new += b[j1:j2]
+                                    i, j = i2, j2
+                           assert (i, j) == (len(a), len(b))
+                           assert new == b
+                           if engine == 'myers':
+                                    assert matched == lcs_length(a, b)
+
+
+def test_page_anchored_matcher():
+         """
+         Checks, that identical pages are matched as a whole, even where another
+         alignment of the same cost exists: the 9 stays on page 3.
+         Only the fast engines anchor, difflib is the reference.
+         """
+         from array import array
+         from difflib import SequenceMatcher
+         a = array('i', [1, 2, 3,  4, 5, 6,  7, 8, 9,  10, 11])
+         pa = array('i', [1, 1, 1,  2, 2, 2,  3, 3, 3,  4, 4])
+         b = array('i', [1, 2, 3,  4, 0, 6,  7, 8, 9,  9, 10, 11])
+         pb = array('i', [1, 1, 1,  2, 2, 2,  3, 3, 3,  4, 4, 4])
+         for engine in pdf_highlight.diff_engines[1:]:
+                  opcodes = pdf_highlight.word_matcher(a, b, pa, pb, engine).get_opcodes()
+                  assert opcodes == [('equal', 0, 4, 0, 4), ('replace', 4, 5, 4, 5), ('equal', 5, 9, 5, 9), 
+                                     ('insert', 9, 9, 9, 10), ('equal', 9, 11, 10, 12)]
+         # difflib is the unanchored reference.
+         opcodes = pdf_highlight.word_matcher(a, b, pa, pb, 'difflib').get_opcodes()
+         assert opcodes == SequenceMatcher(None, a, b, autojunk=False).get_opcodes()
+         blocks = []
+         ranges = pdf_highlight.diff_split([1, 2, 3, 4, 5, 6, 7, 8], [1, 2, 0, 4, 5, 9, 7, 8], 0, 8, 0, 8, blocks)
+         assert ranges == [(2, 3, 2, 3), (5, 6, 5, 6)]
+         assert sorted(blocks) == [(0, 0, 2), (3, 3, 1), (4, 4, 1), (6, 6, 2)]
+
+
+def test_wordtable():
+         """
+         Checks, that a WordTable indexes like the list of DecoratedWord it replaces.
+         """
+         wl = pdf_highlight.WordTable()
+         wl.add_textline('  foo bar\tfoo ', 3, 'c', 10.0, 20.0, 140.0, 9.0, 2)
+         wl.add_textline('cut off', 3, 'b', 90.0, 20.0, 70.0, 9.0, 2, (0, 0, 100, 100))
+         assert [w[0] for w in wl] == ['foo', 'bar', 'foo', 'cut']
+         assert wl[1] == ['bar', '  foo bar\tfoo ', 6, {'p':3, 'l':'c', 'f':2, 'x':10.0, 'y':20.0, 'w':140.0, 'h':9.0}]
+         assert wl.tok[0] == wl.tok[2] != wl.tok[1]
+         assert wl.location(3) == 'p3b'
+         txt = pdf_highlight.WordTable(wl.interner)
+         txt.add_word('bar', 7)
+         assert txt.tok[0] == wl.tok[1]
+         assert txt[0] == ['bar', None, None, {'l':7}]
+         assert txt.location(0) == '#l7'
+         copy = pdf_highlight.WordTable.fromstring(wl.tostring())
+         assert [list(w) for w in copy] == [list(w) for w in wl]
+         assert copy.interner.intern('bar') == wl.tok[1]
+
+
+def test_move_candidates():
+         """
+         Checks, that move_candidates() never misses a pair, that
+         SequenceMatcher.ratio() would accept.
+         """
+         import random
+         from difflib import SequenceMatcher
+         rnd = random.Random(7)
+         for t in range(50):
+                  seqs = [[rnd.randint(0, 12) for i in range(rnd.randint(1, 15))] for k in range(12)]
+                  seqs_a = seqs[:6] + [s[1:] + [rnd.randint(0, 12)] for s in seqs[6:]]
+                  seqs_b = seqs[6:]
+                  for sim in (0.3, 0.6, 0.75, 0.95, 1.0):
+                           cand = pdf_highlight.move_candidates(seqs_a, seqs_b, sim)
+                           assert cand == sorted(cand)
+                           for i, a in enumerate(seqs_a):
+                                    for j, b in enumerate(seqs_b):
+                                             if SequenceMatcher(None, a, b, autojunk=False).ratio() >= sim:
+                                                      assert (i, j) in cand
+
+
+class FakeFont():
+         def metrics(self, str):
+                  return [(0, 0, 0, 0, 3 + ord(c) % 5) for c in str]
+
+
+def test_font_advances():
+         font = FakeFont()
+         cached = pdf_highlight.FontAdvances(font)
+         text = u'the quick brown fox'
+         for start, count in ((0, 3), (4, 5), (16, 3), (16, 9), (30, 2)):
+                  assert pdf_highlight.rendered_text_pos(text, start, count, cached, 10.0, 200.0) == \
+                         pdf_highlight.rendered_text_pos(text, start, count, font, 10.0, 200.0)
+         assert pdf_highlight.rendered_text_width(text, cached) == pdf_highlight.rendered_text_width(text, font)
+
+
+def test_afm_metrics():
+         assert pdf_highlight.afm_font_name('ABCDEF+Arial-BoldMT') == 'Helvetica-Bold'
+         assert pdf_highlight.afm_font_name('TimesNewRomanPS-ItalicMT') == 'Times-Italic'
+         assert pdf_highlight.afm_font_name('DejaVuSansMono') == 'Courier'
+         font = pdf_highlight.AFMMetrics('Times', 10)
+         assert [round(m[4], 3) for m in font.metrics(u'iW\u4e2d')] == [2.78, 9.44, 5.0]
+
+
+def test_hunspell_dict(tmpdir):
+         tmpdir.join('t.aff').write('SET UTF-8\nFORBIDDENWORD !\nPFX A Y 1\nPFX A 0 re .\n' +
+                                    'SFX D Y 2\nSFX D y ied [^aeiou]y\nSFX D 0 ed [^ey]\n')
+         tmpdir.join('t.dic').write('3\nwork/AD\ncarry/D\nParis\nbadword/!\n')
+         d = pdf_highlight.HunspellDict([str(tmpdir.join('t.dic'))], wordlists=[])
+         assert d.unknown_words(['work', 'Work', 'WORK', 'reworked', 'carried', 'carryed',
+                                 'Paris', 'paris', 'badword']) == ['carryed', 'paris', 'badword']
+
+
+def test_search_matcher():
+         m = pdf_highlight.SearchMatcher(['he', 'a.c'], ['she', 'hers', 'his', 'C++'], nocase=True)
+         assert m.terms == ['he', 'a.c', 'she', 'hers', 'his', 'C++']
+         assert m.finditer(u'ushers abc his c++ he') == [(1, 4, 2), (7, 10, 1), (11, 14, 4), (15, 18, 5), (19, 21, 0)]
+         assert pdf_highlight.SearchMatcher(['o.']).finditer(u'foo bar') == [(1, 3, 0)]
+         assert pdf_highlight.SearchMatcher(['ab?', 'a.c']).finditer(u'abc') == [(0, 2, 0)]     # leftmost first
+         # the groups inside the patterns count against the limit of re, too.
+         m = pdf_highlight.SearchMatcher(['(a%d)b' % i for i in range(60)])
+         assert len(m.regexps) == 2
+         assert m.finditer(u'xa7b a42b') == [(1, 4, 7), (5, 9, 42)]
+         # backreferences and inline flags keep their meaning.
+         m = pdf_highlight.SearchMatcher([r'(\w)\1', '(?i)foo', 'Ba.'])
+         assert m.finditer(u'BAR Bar FOO xx') == [(4, 7, 2), (8, 11, 1), (12, 14, 0)]
+
+
+def test_search_index():
+         dom = fake_pdftohtml(1, 3, {1: [('Times', 10)], 2: [('Times', 10), ('Arial', 12)], 3: [('Arial', 12)]})
+         idx = pdf_highlight.SearchIndex('key')
+         for p in pdf_highlight.dom_pages(dom):
+                  idx.add_page(p)
+         idx.finish()
+         idx = pdf_highlight.SearchIndex.fromstring(idx.tostring())
+         assert idx.key == 'key' and [pg['nr'] for pg in idx.pages] == [1, 2, 3]
+         assert idx.pages[1]['fonts'] == [(1, 'Arial', '12')]
+         assert list(idx.run_page) == [1, 2, 2, 3]
+         assert idx.candidate_runs(pdf_highlight.SearchMatcher(['p2'])) == [1, 2]
+         assert idx.candidate_runs(pdf_highlight.SearchMatcher([], ['P3'], nocase=True)) == [3]
+         assert idx.candidate_runs(pdf_highlight.SearchMatcher(['p[13]'])) is None
+
+
+def test_stamp_xobject():
+         """
+         Checks, that a stamped page still parses, when its contents end without
+         whitespace, and that mergePage() keeps q and Q balanced.
+         """
+         from PyPDF2 import PdfFileWriter, pdf, generic
+         output = PdfFileWriter()
+         page = pdf.PageObject.createBlankPage(None, 100, 100)
+         c = generic.DecodedStreamObject()
+         c.setData('BT /F1 12 Tf (x) Tj ET')
+         page[generic.NameObject('/Contents')] = output._addObject(c)
+         xobj = output._addObject(generic.DictionaryObject())
+         pdf_highlight.stamp_xobject(output, page, '/Stamp', xobj, *pdf_highlight.stamp_streams(output, '/Stamp'))
+         page.mergePage(pdf.PageObject.createBlankPage(None, 100, 100))
+         ops = [op for operands, op in pdf.ContentStream(page.getContents(), output).operations]
+         assert ops == ['q', 'q', 'BT', 'Tf', 'Tj', 'ET', 'Q', 'Do', 'Q']
+
+
+def test_write_incremental(tmpdir):
+         """
+         Checks, that the new document info is in the incremental update, and
+         that inputs with cross-reference streams are recognized.
+         """
+         from reportlab.pdfgen import canvas
+         from PyPDF2 import PdfFileReader, PdfFileWriter, generic
+         infile, outfile = str(tmpdir.join('in.pdf')), str(tmpdir.join('out.pdf'))
+         c = canvas.Canvas(infile)
+         c.drawString(100, 100, 'hello')
+         c.save()
+         assert pdf_highlight.pdf_startxref(infile)[1] == False
+         reader = PdfFileReader(open(infile, 'rb'))
+         writer = PdfFileWriter()
+         writer.addPage(reader.getPage(0))
+         info = reader.getDocumentInfo()
+         info[generic.NameObject('/DiffCmd')] = generic.createStringObject('pdf_highlight.py -c')
+         pdf_highlight.write_incremental(infile, outfile, reader, writer, info)
+         out = PdfFileReader(open(outfile, 'rb'))
+         assert out.getDocumentInfo()['/DiffCmd'] == 'pdf_highlight.py -c'
+         assert out.getNumPages() == 1 and open(outfile, 'rb').read().startswith(open(infile, 'rb').read())
+
+         xref = '%PDF-1.5\n1 0 obj\n<< /Type /XRef /Size 2 /W [1 2 1] /Length 0 >>\nstream\n\nendstream\nendobj\n'
+         tmpdir.join('xref.pdf').write(xref + 'startxref\n9\n%%EOF\n')
+         assert pdf_highlight.pdf_startxref(str(tmpdir.join('xref.pdf'))) == (9, True)